@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+from django.core.cache import cache
+
+# Seconds for which fetched transaction details are kept
+DETAILS_TTL = 30
+# Number of transaction details kept in memory by every process
+LOCAL_SIZE = 1024
+
+_local = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def _key(transaction):
+    # Bump the version whenever the pickled form of TransactionDetails changes
+    return "pretix_sofort_details_v3_{}".format(transaction)
+
+
+def get_details(transaction):
+    """
+    Returns the most recently fetched ``TransactionDetails`` of the given transaction, if they are not older
+    than ``DETAILS_TTL`` seconds. The in-process tier is checked before Django's cache.
+    """
+    with _local_lock:
+        entry = _local.get(transaction)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                _local.move_to_end(transaction)
+                return entry[1]
+            del _local[transaction]
+
+    td = cache.get(_key(transaction))
+    if td is not None:
+        _set_local(td)
+    return td
+
+
+def set_details(td):
+    # The status_modified of the cached details is compared against incoming notifications by the caller,
+    # so a single entry per transaction is all we need.
+    cache.set(_key(td.transaction), td, timeout=DETAILS_TTL)
+    _set_local(td)
+
+
+def invalidate_details(transaction):
+    cache.delete(_key(transaction))
+    with _local_lock:
+        _local.pop(transaction, None)
+
+
+def _set_local(td):
+    with _local_lock:
+        _local[td.transaction] = (time.monotonic() + DETAILS_TTL, td)
+        _local.move_to_end(td.transaction)
+        while len(_local) > LOCAL_SIZE:
+            _local.popitem(last=False)
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+
+from ...models import ReferencedSofortTransaction
+
+
+class Command(BaseCommand):
+    help = "Link Sofort transactions that were started before payments were referenced directly to their payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        qs = ReferencedSofortTransaction.objects.filter(payment__isnull=True)
+        total = qs.count()
+        done = 0
+        linked = 0
+        last_pk = 0
+
+        while True:
+            rsos = list(
+                qs.filter(pk__gt=last_pk).order_by("pk")[: options["chunk_size"]]
+            )
+            if not rsos:
+                break
+            last_pk = rsos[-1].pk
+
+            payments = {}
+            for p in OrderPayment.objects.filter(
+                order_id__in={rso.order_id for rso in rsos},
+                provider__startswith="sofort",
+            ):
+                payments.setdefault(p.order_id, []).append(p)
+
+            changed = []
+            for rso in rsos:
+                rso.payment = ReferencedSofortTransaction.match_payment(
+                    payments.get(rso.order_id, []), rso.reference
+                )
+                if rso.payment:
+                    changed.append(rso)
+            ReferencedSofortTransaction.objects.bulk_update(changed, ["payment"])
+
+            done += len(rsos)
+            linked += len(changed)
+            self.stdout.write("{}/{} transactions processed".format(done, total))
+
+        self.stdout.write(
+            self.style.SUCCESS("Linked {} of {} transactions.".format(linked, total))
+        )
@@ -0,0 +1,94 @@
+import json
+import logging
+import time
+from django.conf import settings
+from pretix.base.metrics import Counter, Histogram
+
+# Write a structured log line for every timed span and event to the ``pretix_sofort.timing`` logger
+LOG_TIMINGS = settings.CONFIG_FILE.getboolean("sofort", "log_timings", fallback=False)
+ENABLED = settings.METRICS_ENABLED or LOG_TIMINGS
+
+timing_logger = logging.getLogger("pretix_sofort.timing")
+
+sofort_http_connections = Counter(
+    "pretix_sofort_http_connections_total",
+    "Connections used for calls to the Sofort API, by whether a kept-alive connection was reused (hit) or a "
+    "new one had to be opened (miss).",
+    ["result"],
+)
+sofort_duration_seconds = Histogram(
+    "pretix_sofort_duration_seconds",
+    "Time spent in the parts of processing Sofort payments, such as API calls or building and parsing XML.",
+    ["span"],
+    buckets=[.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf")],
+)
+sofort_events = Counter(
+    "pretix_sofort_events_total",
+    "Outcomes of processing Sofort transactions and refunds.",
+    ["event"],
+)
+
+
+def inc(metric, amount=1, **labels):
+    # pretix' metrics write to redis unconditionally, so we only touch them if metrics are enabled
+    if settings.METRICS_ENABLED:
+        metric.inc(amount, **labels)
+
+
+def event(name):
+    """
+    Counts an outcome, e.g. which branch processing a transaction took.
+    """
+    if settings.METRICS_ENABLED:
+        sofort_events.inc(event=name)
+    if LOG_TIMINGS:
+        timing_logger.info(json.dumps({"event": name}))
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        if settings.METRICS_ENABLED:
+            sofort_duration_seconds.observe(duration, span=self.name)
+        if LOG_TIMINGS:
+            timing_logger.info(
+                json.dumps(
+                    {
+                        "span": self.name,
+                        "duration": round(duration, 6),
+                        "error": exc_type.__name__ if exc_type else None,
+                    }
+                )
+            )
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def span(name):
+    """
+    Returns a context manager measuring the time spent in its block. Unless metrics or timing logs are
+    enabled, this is a shared object that does nothing.
+    """
+    if not ENABLED:
+        return _no_span
+    return _Span(name)
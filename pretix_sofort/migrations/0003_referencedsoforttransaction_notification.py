@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_sofort", "0002_referencedsoforttransaction_payment"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="referencedsoforttransaction",
+            name="notification_time",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="referencedsoforttransaction",
+            name="notification_pending",
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretixbase", "0097_auto_20180722_0804"),
+        ("pretix_sofort", "0003_referencedsoforttransaction_notification"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QueuedSofortRefund",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "state",
+                    models.CharField(db_index=True, default="queued", max_length=16),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("claimed", models.DateTimeField(null=True)),
+                (
+                    "refund",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sofort_queue",
+                        to="pretixbase.OrderRefund",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_sofort", "0004_queuedsofortrefund"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="referencedsoforttransaction",
+            name="next_check",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
@@ -7,3 +7,35 @@ class ReferencedSofortTransaction(models.Model):
     payment = models.ForeignKey(
         "pretixbase.OrderPayment", null=True, on_delete=models.CASCADE
     )
+    # Time of the last status notification received for this transaction, and whether it still
+    # needs to be processed by a background task.
+    notification_time = models.DateTimeField(null=True)
+    notification_pending = models.BooleanField(default=False, db_index=True)
+    # Earliest time the periodic sweep looks up this transaction again
+    next_check = models.DateTimeField(null=True, db_index=True)
+
+    @staticmethod
+    def match_payment(payments, reference):
+        """
+        Returns the latest of the given payments that belongs to the transaction ``reference``.
+        """
+        matches = [p for p in payments if p.info_data.get("transaction") == reference]
+        return max(matches, key=lambda p: p.local_id) if matches else None
+
+
+class QueuedSofortRefund(models.Model):
+    """
+    A refund waiting to be submitted to Sofort in a batch. Deleted once its outcome is recorded.
+    """
+    STATE_QUEUED = "queued"
+    # Claimed by a run that is talking to Sofort
+    STATE_SUBMITTING = "submitting"
+    # The run died before recording the outcome, someone has to check the refund with Sofort
+    STATE_UNKNOWN = "unknown"
+
+    refund = models.OneToOneField(
+        "pretixbase.OrderRefund", related_name="sofort_queue", on_delete=models.CASCADE
+    )
+    state = models.CharField(max_length=16, default=STATE_QUEUED, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    claimed = models.DateTimeField(null=True)
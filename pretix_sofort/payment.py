@@ -3,23 +3,162 @@ from typing import Union
 import hashlib
 import json
 import logging
-import requests
-from collections import OrderedDict
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
 from django import forms
+from django.conf import settings
 from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum
 from django.http import HttpRequest
 from django.template.loader import get_template
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
-from pretix.base.models import OrderPayment, OrderRefund
+from itertools import islice
+from pretix.base.models import (
+    LogEntry, Order, OrderPayment, OrderRefund, Quota,
+)
 from pretix.base.payment import BasePaymentProvider, PaymentException
+from pretix.helpers.database import OF_SELF
 from pretix.multidomain.urlreverse import build_absolute_uri
-from requests import HTTPError
 
-from . import sofort
-from .models import ReferencedSofortTransaction
+from . import cache as details_cache, metrics, sofort, transport
+from .models import QueuedSofortRefund, ReferencedSofortTransaction
 
 logger = logging.getLogger(__name__)
 
+# Parts of the transaction data that are not personal data and survive data shredding
+SHRED_KEEP_KEYS = (
+    "payment_method",
+    "amount",
+    "status_reason",
+    "time",
+    "exchange_rate",
+    "transaction",
+    "currency_code",
+    "project_id",
+    "costs",
+    "status_modified",
+    "status",
+    "reasons",
+    "language_code",
+)
+SHRED_CHUNK_SIZE = 1000
+
+# Parts of the transaction data that tell whether Sofort reports anything new about a transaction
+STATUS_KEYS = ("status", "status_modified", "amount_refunded")
+
+# Number of transactions we ask Sofort about in a single transaction request
+TRANSACTION_REQUEST_BATCH_SIZE = 100
+# Maximum number of refunds we submit to Sofort in a single request
+REFUND_BATCH_SIZE = 100
+BULK_REFUNDS = settings.CONFIG_FILE.getboolean("sofort", "bulk_refunds", fallback=False)
+# Seconds for which the outcome of a status lookup is shared with other triggers for the same transaction
+COALESCE_WINDOW = 10
+# Seconds a trigger waits for a concurrent lookup of the same transaction before doing its own. This blocks a
+# web worker, so it is kept short; a slow lookup is rather duplicated than waited for.
+COALESCE_WAIT = 1.5
+COALESCE_POLL_INTERVAL = 0.05
+# Seconds after which the claim on a lookup expires in case its holder died
+COALESCE_LOCK_TIMEOUT = 60
+
+# Number of events whose resolved settings every process keeps
+CONFIG_CACHE_SIZE = 1000
+# Seconds for which the absolute URLs of an event are cached
+URLS_TTL = 600
+# Seconds a customer has to complete a payment at Sofort
+MULTIPAY_TIMEOUT = 3600
+# Repeated attempts to start the same payment reuse the transaction started first, as long as the customer
+# has at least this many seconds left to complete it
+MULTIPAY_REUSE_MARGIN = 600
+# Seconds a repeated attempt waits for a concurrent attempt to finish starting the transaction before it starts
+# its own, and the interval in which it checks
+INITIATION_WAIT = 5
+INITIATION_POLL_INTERVAL = 0.2
+
+SofortConfig = namedtuple("SofortConfig", ("customer_id", "api_key", "project_id"))
+_configs = OrderedDict()
+
+
+def _config_version(event_id):
+    key = "pretix_sofort_config_version_{}".format(event_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key)
+    return version
+
+
+def invalidate_config(event_id):
+    cache.set(
+        "pretix_sofort_config_version_{}".format(event_id),
+        uuid.uuid4().hex,
+        timeout=None,
+    )
+    _configs.pop(event_id, None)
+
+
+@contextmanager
+def _api_errors():
+    """
+    Turns errors talking to Sofort into a ``PaymentException`` for the user.
+    """
+    try:
+        yield
+    except sofort.SofortError as e:
+        logger.exception("Failure during sofort payment: {}".format(e.message))
+        raise PaymentException(_("Sofort reported an error: {}").format(e.message))
+    except IOError:
+        logger.exception("Failure during sofort payment.")
+        raise PaymentException(
+            _(
+                "We had trouble communicating with Sofort. Please try again and get in touch "
+                "with us if this problem persists."
+            )
+        )
+
+
+def order_hash(order):
+    """
+    Returns the hash identifying ``order`` in the URLs customers return to from Sofort.
+    """
+    return hashlib.sha1(order.secret.lower().encode()).hexdigest()
+
+
+def event_urls(event):
+    """
+    Returns the cached webhook URL of ``event`` and a template of its return URL.
+    """
+
+    def build():
+        return_url = build_absolute_uri(
+            event,
+            "plugins:pretix_sofort:return",
+            kwargs={"order": "order", "hash": "hash"},
+        )
+        return_url = return_url[: -len("order/hash/")].replace("{", "{{").replace("}", "}}")
+        return (
+            build_absolute_uri(event, "plugins:pretix_sofort:webhook"),
+            return_url + "{order}/{hash}/?state={state}&transaction=-TRANSACTION-",
+        )
+
+    return event.cache.get_or_set("pretix_sofort_urls", build, URLS_TTL)
+
+
+def _shred_info(d):
+    new = {"_shreded": True}
+    for k in SHRED_KEEP_KEYS:
+        if k in d:
+            new[k] = d[k]
+    return new
+
 
 class Sofort(BasePaymentProvider):
     identifier = "sofort"
@@ -72,19 +211,239 @@ class Sofort(BasePaymentProvider):
     def payment_is_valid_session(self, request):
         return True
 
-    def _api_call(self, payload):
-        r = requests.post(
-            "https://api.sofort.com/api/xml",
-            data=payload,
-            auth=(self.settings.get("customer_id"), self.settings.get("api_key")),
-            headers={
-                "Content-Type": "application/xml; charset=UTF-8",
-                "Accept": "application/xml; charset=UTF-8",
-            },
+    @property
+    def config(self):
+        """
+        The credentials of this event, kept by every process until the settings change.
+        """
+        version = _config_version(self.event.pk)
+        entry = _configs.get(self.event.pk)
+        if entry is None or entry[0] != version:
+            entry = _configs[self.event.pk] = (
+                version,
+                SofortConfig(
+                    customer_id=self.settings.get("customer_id"),
+                    api_key=self.settings.get("api_key"),
+                    project_id=self.settings.get("project_id"),
+                ),
+            )
+            while len(_configs) > CONFIG_CACHE_SIZE:
+                _configs.popitem(last=False)
+        return entry[1]
+
+    def _api_call(self, payload, idempotent=False):
+        config = self.config
+        with metrics.span("api_call"):
+            return transport.post(
+                config.customer_id, config.api_key, payload, idempotent=idempotent
+            ).content
+
+    def _fetch_transaction_details(self, transactions):
+        """
+        Fetches the details of many transactions in batches, keyed by transaction ID.
+        """
+        transactions = list(transactions)
+        details = {}
+        for i in range(0, len(transactions), TRANSACTION_REQUEST_BATCH_SIZE):
+            r = sofort.TransactionRequest(
+                transactions=transactions[i:i + TRANSACTION_REQUEST_BATCH_SIZE]
+            )
+            with _api_errors():
+                with metrics.span("transaction_request_to_xml"):
+                    payload = r.to_xml()
+                response = self._api_call(payload, idempotent=True)
+                with metrics.span("transactions_from_xml"):
+                    trans = sofort.Transactions.from_xml(response)
+            for td in trans.details:
+                details[td.transaction] = td
+                details_cache.set_details(td)
+        return details
+
+    @staticmethod
+    def _transition_for(payment, td):
+        """
+        Returns the transition (``"confirm"``, ``"refund"``, ``"loss"`` or ``None``) ``td`` calls for.
+        """
+        if td.status in (
+            "pending",
+            "received",
+            "untraceable",
+        ) and payment.state in (
+            OrderPayment.PAYMENT_STATE_CREATED,
+            OrderPayment.PAYMENT_STATE_PENDING,
+            OrderPayment.PAYMENT_STATE_FAILED,
+        ):
+            return "confirm"
+        elif (
+            td.status == "refunded"
+            and payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+        ):
+            return "refund"
+        elif (
+            td.status == "loss"
+            and payment.state != OrderPayment.PAYMENT_STATE_FAILED
+        ):
+            return "loss"
+
+    @staticmethod
+    def _is_known(payment, td):
+        """
+        Returns whether the transaction data stored with ``payment`` already reflects ``td``.
+        """
+        info = payment.info_data
+        return all(
+            info.get(k) == td.text(k) for k in STATUS_KEYS
+        )
+
+    @staticmethod
+    def _lock_payment(rso, td):
+        """
+        Returns the payment referenced by ``rso``, locked and with its order and event loaded.
+        """
+        payments = OrderPayment.objects.select_for_update(of=OF_SELF).select_related(
+            "order", "order__event"
         )
-        if r.status_code >= 500:
-            raise HTTPError()
-        return r.content
+        if rso.payment_id:
+            payment = payments.get(pk=rso.payment_id)
+        else:
+            payment = ReferencedSofortTransaction.match_payment(
+                payments.filter(order_id=rso.order_id, provider__startswith="sofort"),
+                td.transaction,
+            )
+            if not payment:
+                payment = rso.order.payments.create(
+                    state=OrderPayment.PAYMENT_STATE_CREATED,
+                    provider="sofort",
+                    amount=td.amount,
+                    info=json.dumps({"transaction": td.transaction, "status": "initiated"}),
+                )
+            rso.payment = payment
+            rso.save(update_fields=["payment"])
+        rso.payment = payment
+        return payment
+
+    def _handle_transaction_details(self, rso, td):
+        """
+        Applies the state reported by Sofort to the payment. Returns ``False`` if nothing changed.
+        """
+        if (
+            rso.payment
+            and self._is_known(rso.payment, td)
+            and not self._transition_for(rso.payment, td)
+        ):
+            return False
+
+        quota_exceeded = False
+        with transaction.atomic():
+            payment = self._lock_payment(rso, td)
+            order = payment.order
+            changed = not self._is_known(payment, td)
+            action = self._transition_for(payment, td)
+            if changed:
+                payment.info = td.to_json(no_sepa_data=True)
+                payment.save(update_fields=["info"])
+            if changed or action:
+                order.log_action(
+                    "pretix_sofort.sofort.event", data=td.to_data(no_sepa_data=True)
+                )
+
+            if action == "confirm":
+                try:
+                    with metrics.span("payment_confirm"):
+                        payment.confirm()
+                except Quota.QuotaExceededException:
+                    quota_exceeded = True
+            elif action == "refund":
+                known_sum = payment.refunds.filter(
+                    state__in=(
+                        OrderRefund.REFUND_STATE_DONE,
+                        OrderRefund.REFUND_STATE_TRANSIT,
+                        OrderRefund.REFUND_STATE_CREATED,
+                        OrderRefund.REFUND_SOURCE_EXTERNAL,
+                    )
+                ).aggregate(s=Sum("amount"))["s"] or Decimal("0.00")
+                if known_sum < td.amount_refunded:
+                    payment.create_external_refund(
+                        amount=td.amount_refunded - known_sum
+                    )
+            elif action == "loss":
+                payment.state = OrderPayment.PAYMENT_STATE_FAILED
+                payment.save(update_fields=["state"])
+                order.log_action(
+                    "pretix.event.order.payment.failed",
+                    {
+                        "local_id": payment.local_id,
+                        "provider": payment.provider,
+                        "info": str(td),
+                    },
+                )
+                if order.pending_sum > 0:
+                    order.status = Order.STATUS_PENDING
+                    order.save()
+                    order.create_transactions()
+
+        if quota_exceeded:
+            raise PaymentException(
+                _(
+                    "Your payment could not be handled as the event sold out in the meantime. "
+                    "Please contact the organizer for more information."
+                )
+            )
+        return action is not None
+
+    def _process_transaction(self, rso, notification_time=None):
+        """
+        Fetches and applies the state of a transaction, sharing the outcome with concurrent calls.
+        Returns a dictionary with the keys ``found`` and ``handled``.
+        """
+        result_key = "pretix_sofort_result_{}".format(rso.reference)
+        lock_key = "pretix_sofort_inflight_{}".format(rso.reference)
+        not_before = notification_time.timestamp() if notification_time else 0
+
+        deadline = time.monotonic() + COALESCE_WAIT
+        while True:
+            result = cache.get(result_key)
+            if result and result["fetched_at"] >= not_before:
+                metrics.event("transaction_coalesced")
+                return result
+            locked = cache.add(lock_key, True, timeout=COALESCE_LOCK_TIMEOUT)
+            if locked:
+                break
+            if time.monotonic() > deadline:
+                # Whoever holds the lock is taking too long, let's not keep the customer waiting any longer.
+                # The lock stays with its holder.
+                metrics.event("transaction_coalesce_timeout")
+                break
+            time.sleep(COALESCE_POLL_INTERVAL)
+
+        try:
+            td = details_cache.get_details(rso.reference)
+            if td is not None:
+                if notification_time and notification_time > td.status_modified:
+                    details_cache.invalidate_details(rso.reference)
+                elif rso.payment and not self._transition_for(rso.payment, td):
+                    metrics.event("transaction_cached")
+                    return {"found": True, "handled": False, "fetched_at": 0}
+
+            fetched_at = time.time()
+            td = self._fetch_transaction_details([rso.reference]).get(rso.reference)
+            if td is None:
+                metrics.event("transaction_not_found")
+                handled = False
+            else:
+                with metrics.span("handle_transaction"):
+                    handled = self._handle_transaction_details(rso, td)
+                metrics.event("transaction_handled" if handled else "transaction_unchanged")
+            result = {
+                "found": td is not None,
+                "handled": handled,
+                "fetched_at": fetched_at,
+            }
+            cache.set(result_key, result, timeout=COALESCE_WINDOW)
+            return result
+        finally:
+            if locked:
+                cache.delete(lock_key)
 
     def redirect(self, request, url):
         if request.session.get("iframe_session", False):
@@ -106,65 +465,133 @@ class Sofort(BasePaymentProvider):
         else:
             return str(url)
 
+    @staticmethod
+    def _reusable_payment_url(info, key):
+        """
+        Returns the payment URL of an earlier transaction for the same amount, if still usable.
+        """
+        if info.get("status") != "initiated" or info.get("initiation_key") != key:
+            return None
+        initiated = parse_datetime(info.get("initiated") or "")
+        if initiated and now() - initiated < timedelta(
+            seconds=MULTIPAY_TIMEOUT - MULTIPAY_REUSE_MARGIN
+        ):
+            return info.get("payment_url")
+
+    @staticmethod
+    def _is_initiating(info, key):
+        """
+        Returns whether another attempt is starting a transaction for the same amount right now.
+        """
+        initiating = info.get("initiating") or {}
+        if initiating.get("key") != key:
+            return False
+        since = parse_datetime(initiating.get("since") or "")
+        return bool(since) and now() - since < timedelta(seconds=INITIATION_WAIT)
+
+    def _claim_initiation(self, payment, key, wait):
+        """
+        Returns a reusable payment URL, or our claim to start a new transaction. With ``wait``, returns
+        ``False`` while another attempt is starting one.
+        """
+        with transaction.atomic():
+            locked = OrderPayment.objects.select_for_update(of=OF_SELF).get(pk=payment.pk)
+            info = locked.info_data
+            payment_url = self._reusable_payment_url(info, key)
+            if payment_url:
+                return payment_url, None
+            if wait and self._is_initiating(info, key):
+                return False, None
+            claim = uuid.uuid4().hex
+            info["initiating"] = {"key": key, "claim": claim, "since": now().isoformat()}
+            locked.info_data = info
+            locked.save(update_fields=["info"])
+            return None, claim
+
+    def _release_initiation(self, payment, claim):
+        with transaction.atomic():
+            locked = OrderPayment.objects.select_for_update(of=OF_SELF).get(pk=payment.pk)
+            info = locked.info_data
+            if (info.get("initiating") or {}).get("claim") == claim:
+                del info["initiating"]
+                locked.info_data = info
+                locked.save(update_fields=["info"])
+
     def execute_payment(self, request: HttpRequest, payment: OrderPayment):
         request.session["payment_sofort_order_secret"] = payment.order.secret
-        shash = hashlib.sha1(payment.order.secret.lower().encode()).hexdigest()
+        key = "{}:{}".format(payment.pk, payment.amount)
+        # Concurrent attempts to start the same payment, e.g. after a double click, use the same transaction,
+        # as long as starting it does not take too long.
+        deadline = time.monotonic() + INITIATION_WAIT
+        while True:
+            payment_url, claim = self._claim_initiation(payment, key, wait=time.monotonic() < deadline)
+            if payment_url is not False:
+                break
+            time.sleep(INITIATION_POLL_INTERVAL)
+
+        if payment_url:
+            metrics.event("multipay_reused")
+            return self.redirect(request, payment_url)
+
+        try:
+            payment_url = self._start_transaction(payment, key)
+        except BaseException:
+            self._release_initiation(payment, claim)
+            raise
+        return self.redirect(request, payment_url)
+
+    def discard_payment_url(self, payment: OrderPayment, reference):
+        """
+        Makes sure the transaction ``reference`` is not reused, e.g. after the customer cancelled it.
+        """
+        with transaction.atomic():
+            locked = OrderPayment.objects.select_for_update(of=OF_SELF).get(pk=payment.pk)
+            info = locked.info_data
+            if info.get("transaction") == reference and "payment_url" in info:
+                del info["payment_url"]
+                info.pop("initiation_key", None)
+                locked.info_data = info
+                locked.save(update_fields=["info"])
+
+    def _start_transaction(self, payment, key):
+        webhook_url, return_url = event_urls(self.event)
+        shash = order_hash(payment.order)
         r = sofort.MultiPay(
-            project_id=self.settings.get("project_id"),
+            project_id=self.config.project_id,
             amount=payment.amount,
             currency_code=self.event.currency,
             reasons=[payment.order.full_code, "-TRANSACTION-"],
             user_variables=[payment.order.full_code],
-            success_url=build_absolute_uri(
-                self.event,
-                "plugins:pretix_sofort:return",
-                kwargs={
-                    "order": payment.order.code,
-                    "hash": shash,
-                },
-            )
-            + "?state=success&transaction=-TRANSACTION-",
-            abort_url=build_absolute_uri(
-                self.event,
-                "plugins:pretix_sofort:return",
-                kwargs={
-                    "order": payment.order.code,
-                    "hash": shash,
-                },
-            )
-            + "?state=abort&transaction=-TRANSACTION-",
-            timeout_url=build_absolute_uri(
-                self.event,
-                "plugins:pretix_sofort:return",
-                kwargs={
-                    "order": payment.order.code,
-                    "hash": shash,
-                },
-            )
-            + "?state=timeout&transaction=-TRANSACTION-",
-            notification_urls=[
-                build_absolute_uri(self.event, "plugins:pretix_sofort:webhook")
-            ],
+            success_url=return_url.format(
+                order=payment.order.code, hash=shash, state="success"
+            ),
+            abort_url=return_url.format(
+                order=payment.order.code, hash=shash, state="abort"
+            ),
+            timeout_url=return_url.format(
+                order=payment.order.code, hash=shash, state="timeout"
+            ),
+            notification_urls=[webhook_url],
+            timeout=MULTIPAY_TIMEOUT,
         )
-        try:
-            trans = sofort.NewTransaction.from_xml(self._api_call(r.to_xml()))
-        except sofort.SofortError as e:
-            logger.exception("Failure during sofort payment: {}".format(e.message))
-            raise PaymentException(_("Sofort reported an error: {}").format(e.message))
-        except IOError:
-            logger.exception("Failure during sofort payment.")
-            raise PaymentException(
-                _(
-                    "We had trouble communicating with Sofort. Please try again and get in touch "
-                    "with us if this problem persists."
-                )
-            )
+        with _api_errors():
+            with metrics.span("multipay_to_xml"):
+                payload = r.to_xml()
+            response = self._api_call(payload)
+            with metrics.span("new_transaction_from_xml"):
+                trans = sofort.NewTransaction.from_xml(response)
         ReferencedSofortTransaction.objects.get_or_create(
             order=payment.order, reference=trans.transaction, payment=payment
         )
-        payment.info_data = {"transaction": trans.transaction, "status": "initiated"}
+        payment.info_data = {
+            "transaction": trans.transaction,
+            "status": "initiated",
+            "payment_url": trans.payment_url,
+            "initiation_key": key,
+            "initiated": now().isoformat(),
+        }
         payment.save(update_fields=["info"])
-        return self.redirect(request, trans.payment_url)
+        return trans.payment_url
 
     def payment_pending_render(self, request: HttpRequest, payment: OrderPayment):
         retry = True
@@ -204,94 +631,142 @@ class Sofort(BasePaymentProvider):
     def payment_partial_refund_supported(self, payment: OrderPayment):
         return True
 
-    def _refund(self, refund):
-        r = sofort.Refunds(
-            refunds=[
-                sofort.Refund(
-                    transaction=refund.payment.info_data.get("transaction"),
-                    amount=refund.amount,
-                    comment=refund.order.full_code,
-                    reason_1=refund.order.full_code,
-                    reason_2=refund.payment.info_data.get("transaction"),
+    def _submit_refunds(self, refunds):
+        """
+        Submits refunds in batches. Returns ``(refund, error)`` tuples, ``error`` is ``None`` if accepted.
+        """
+        results = []
+        for i in range(0, len(refunds), REFUND_BATCH_SIZE):
+            batch = refunds[i:i + REFUND_BATCH_SIZE]
+            r = sofort.Refunds(
+                refunds=[
+                    sofort.Refund(
+                        transaction=refund.payment.info_data.get("transaction"),
+                        amount=refund.amount,
+                        comment=refund.order.full_code,
+                        reason_1=refund.order.full_code,
+                        reason_2=refund.payment.info_data.get("transaction"),
+                    )
+                    for refund in batch
+                ]
+            )
+            try:
+                with _api_errors():
+                    with metrics.span("refunds_to_xml"):
+                        payload = r.to_xml()
+                    response = self._api_call(payload)
+                    with metrics.span("refunds_from_xml"):
+                        response = sofort.Refunds.from_xml(response)
+            except PaymentException as e:
+                metrics.event("refund_batch_failed")
+                results += [(refund, str(e)) for refund in batch]
+                continue
+
+            if len(response.refunds) != len(batch):
+                logger.error(
+                    "Sofort answered {} refunds with {} results.".format(
+                        len(batch), len(response.refunds)
+                    )
                 )
-            ]
-        )
-        try:
-            sofort.Refunds.from_xml(self._api_call(r.to_xml()))
-        except sofort.SofortError as e:
-            logger.exception("Failure during sofort payment: {}".format(e.message))
-            raise PaymentException(_("Sofort reported an error: {}").format(e.message))
-        except IOError:
-            logger.exception("Failure during sofort payment.")
-            raise PaymentException(
-                _(
-                    "We had trouble communicating with Sofort. Please try again and get in touch "
-                    "with us if this problem persists."
+                error = _("Sofort reported an error: {}").format(
+                    _("Unexpected response.")
                 )
-            )
+                results += [(refund, error) for refund in batch]
+                continue
+
+            # Sofort answers with one entry per refund, in the order of the request
+            for refund, result in zip(batch, response.refunds):
+                if result.status == "error":
+                    metrics.event("refund_rejected")
+                    logger.error(
+                        "Sofort rejected refund {}: {}".format(refund.full_id, result.error)
+                    )
+                    results.append(
+                        (refund, _("Sofort reported an error: {}").format(result.error))
+                    )
+                else:
+                    metrics.event("refund_accepted")
+                    results.append((refund, None))
+        return results
+
+    def execute_refunds(self, refunds):
+        """
+        Executes many refunds in batches and records the outcome of every batch right away.
+        """
+        for i in range(0, len(refunds), REFUND_BATCH_SIZE):
+            with metrics.span("submit_refunds"):
+                results = self._submit_refunds(refunds[i:i + REFUND_BATCH_SIZE])
+            for refund, error in results:
+                with transaction.atomic():
+                    if error:
+                        refund.state = OrderRefund.REFUND_STATE_FAILED
+                        refund.save(update_fields=["state"])
+                        refund.order.log_action(
+                            "pretix.event.order.refund.failed",
+                            {
+                                "local_id": refund.local_id,
+                                "provider": refund.provider,
+                                "error": str(error),
+                            },
+                        )
+                    else:
+                        refund.done()
+                    QueuedSofortRefund.objects.filter(refund=refund).delete()
 
     def execute_refund(self, refund: OrderRefund):
-        try:
-            self._refund(refund)
-        except requests.exceptions.RequestException as e:
-            logger.exception("Sofort error: %s" % str(e))
-            raise PaymentException(
-                _(
-                    "We had trouble communicating with Sofort. Please try again and contact "
-                    "support if the problem persists."
-                )
-            )
-        else:
-            refund.done()
+        if BULK_REFUNDS:
+            # Sofort accepts many refunds in one request, so we collect them for a little while instead
+            # of doing one request per refund, e.g. when a whole event is cancelled.
+            from .tasks import schedule_refund_submission
+
+            with transaction.atomic():
+                refund.state = OrderRefund.REFUND_STATE_TRANSIT
+                refund.save(update_fields=["state"])
+                QueuedSofortRefund.objects.create(refund=refund)
+            schedule_refund_submission(self.event)
+            return
+
+        with metrics.span("submit_refunds"):
+            ((refund, error),) = self._submit_refunds([refund])
+        if error:
+            raise PaymentException(error)
+        refund.done()
 
     def shred_payment_info(self, obj: Union[OrderPayment, OrderRefund]):
-        d = obj.info_data
-        new = {"_shreded": True}
-        for k in (
-            "payment_method",
-            "amount",
-            "status_reason",
-            "time",
-            "exchange_rate",
-            "transaction",
-            "currency_code",
-            "transaction",
-            "project_id",
-            "costs",
-            "status_modified",
-            "status",
-            "reasons",
-            "language_code",
-        ):
-            if k in d:
-                new[k] = d[k]
-        obj.info_data = new
+        """
+        Shreds ``obj`` and, on the first call, the Sofort log entries of the whole event in bulk.
+        """
+        obj.info_data = _shred_info(obj.info_data)
         obj.save(update_fields=["info"])
-        for le in (
-            obj.order.all_logentries()
-            .filter(action_type="pretix_sofort.sofort.event")
+
+        if not getattr(self, "_logentries_shredded", False):
+            self._shred_logentries()
+            self._logentries_shredded = True
+
+    def _shred_logentries(self):
+        qs = (
+            LogEntry.objects.filter(
+                event=self.event,
+                action_type="pretix_sofort.sofort.event",
+                shredded=False,
+            )
             .exclude(data="")
-        ):
-            d = le.parsed_data
-            new = {"_shreded": True}
-            for k in (
-                "payment_method",
-                "amount",
-                "status_reason",
-                "time",
-                "exchange_rate",
-                "transaction",
-                "currency_code",
-                "transaction",
-                "project_id",
-                "costs",
-                "status_modified",
-                "status",
-                "reasons",
-                "language_code",
-            ):
-                if k in d:
-                    new[k] = d[k]
-            le.data = json.dumps(new)
-            le.shredded = True
-            le.save(update_fields=["data", "shredded"])
+            .only("pk", "data")
+        )
+        start = time.monotonic()
+        done = 0
+        entries = qs.iterator(chunk_size=SHRED_CHUNK_SIZE)
+        while True:
+            chunk = list(islice(entries, SHRED_CHUNK_SIZE))
+            if not chunk:
+                break
+            for le in chunk:
+                le.data = json.dumps(_shred_info(json.loads(le.data)))
+                le.shredded = True
+            LogEntry.objects.bulk_update(chunk, ["data", "shredded"])
+            done += len(chunk)
+            logger.info(
+                "Shredded {} Sofort log entries of event {} ({:.0f}/s).".format(
+                    done, self.event.pk, done / max(time.monotonic() - start, 0.001)
+                )
+            )
@@ -1,12 +1,20 @@
 import json
+from datetime import timedelta
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.template.loader import get_template
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
+from django_scopes import scopes_disabled
+from pretix.base.models import Event_SettingsStore
 from pretix.base.signals import (
-    logentry_display, register_payment_providers, requiredaction_display,
+    logentry_display, periodic_task, register_payment_providers,
+    requiredaction_display,
 )
+from pretix.helpers.periodic import minimum_interval
 
-from .payment import Sofort
+from .payment import Sofort, invalidate_config
 
 
 @receiver(register_payment_providers, dispatch_uid="payment_sofort")
@@ -14,8 +22,21 @@ def register_payment_provider(sender, **kwargs):
     return [Sofort]
 
 
+@receiver(post_save, sender=Event_SettingsStore, dispatch_uid="sofort_settings_saved")
+@receiver(post_delete, sender=Event_SettingsStore, dispatch_uid="sofort_settings_deleted")
+def invalidate_cached_config(sender, instance, **kwargs):
+    if instance.key.startswith("payment_sofort_"):
+        # Other processes could otherwise load the old settings again before the change is committed
+        transaction.on_commit(lambda: invalidate_config(instance.object_id))
+
+
 @receiver(signal=logentry_display, dispatch_uid="sofort_logentry_display")
 def pretixcontrol_logentry_display(sender, logentry, **kwargs):
+    if logentry.action_type == "pretix_sofort.sofort.refund_unknown":
+        return _(
+            "The submission of refund {local_id} to Sofort was interrupted. Please check in your Sofort "
+            "account whether it has been executed and mark it as done or failed."
+        ).format(local_id=logentry.parsed_data.get("local_id"))
     if logentry.action_type != "pretix_sofort.sofort.event":
         return
 
@@ -46,3 +67,32 @@ def pretixcontrol_action_display(sender, action, request, **kwargs):
 
     ctx = {"data": data, "event": sender, "action": action}
     return template.render(ctx, request)
+
+
+@receiver(signal=periodic_task, dispatch_uid="sofort_submit_queued_refunds")
+@scopes_disabled()
+def submit_queued_refunds(sender, **kwargs):
+    from .tasks import (
+        queued_refunds, report_abandoned_refunds, submit_refunds,
+    )
+
+    report_abandoned_refunds()
+
+    # Catches refunds whose scheduled submission got lost, e.g. in a worker restart
+    for event_id in (
+        queued_refunds()
+        .filter(created__lt=now() - timedelta(minutes=15))
+        .order_by()
+        .values_list("refund__order__event_id", flat=True)
+        .distinct()
+    ):
+        submit_refunds.apply_async(kwargs={"event": event_id})
+
+
+@receiver(signal=periodic_task, dispatch_uid="sofort_sweep_stale_payments")
+@scopes_disabled()
+@minimum_interval(minutes_after_success=5, minutes_after_error=15)
+def reconcile_stale_payments(sender, **kwargs):
+    from .tasks import sweep_stale_payments
+
+    sweep_stale_payments.apply_async()
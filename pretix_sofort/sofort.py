@@ -1,21 +1,158 @@
 import json
 import logging
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from django.utils.dateparse import parse_datetime
+from io import BytesIO
 from lxml import etree
 from lxml.etree import XMLSyntaxError
 from pretix import __version__ as pversion
+from xml.sax.saxutils import escape
 
 from . import __version__
 
 logger = logging.getLogger("pretix_sofort")
 
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" ?>\n'
+INTERFACE_VERSION = "pretix_{}/Sofort_{}".format(pversion, __version__)
+NOTIFY_ON = "received,loss,refunded,pending"
+
+# Static parts of the documents we send, rendered once
+_INTERFACE_VERSION_ELEMENT = "<interface_version>{}</interface_version>".format(
+    escape(INTERFACE_VERSION)
+)
+_NOTIFICATION_URL_ELEMENT = (
+    '<notification_url notify_on="' + NOTIFY_ON + '">{}</notification_url>'
+)
+
+_xpath_error_messages = etree.XPath("error/message/text()", smart_strings=False)
+_xpath_new_transaction = etree.XPath(
+    "/new_transaction/transaction/text()", smart_strings=False
+)
+_xpath_payment_url = etree.XPath(
+    "/new_transaction/payment_url/text()", smart_strings=False
+)
+_xpath_notification_transaction = etree.XPath(
+    "/status_notification/transaction/text()", smart_strings=False
+)
+_xpath_notification_time = etree.XPath(
+    "/status_notification/time/text()", smart_strings=False
+)
+_xpath_refunds = etree.XPath("/refunds/refund")
+
+
+# Maximum number of characters of a payload that is rendered into log messages and errors
+PAYLOAD_LOG_LIMIT = 4096
+
+_redacted_elements = re.compile(r"<(iban|account_number)>([^<]*)</\1>")
+
+
+def _mask_iban(iban):
+    if len(iban) > 8:
+        return iban[:4] + "*" * (len(iban) - 8) + iban[-4:]
+    return "*" * len(iban)
+
+
+def _redact(match):
+    tag, value = match.groups()
+    if tag == "iban":
+        value = _mask_iban(value)
+    else:
+        value = "*" * len(value)
+    return "<{0}>{1}</{0}>".format(tag, value)
+
+
+def _redact_account(account):
+    redacted = {k: v for k, v in account.items() if k != "account_number"}
+    if redacted.get("iban"):
+        redacted["iban"] = _mask_iban(redacted["iban"])
+    return redacted
+
+
+# Serializes the plain values of parsed responses, which can never contain circular references
+_json_encoder = json.JSONEncoder(check_circular=False, separators=(",", ":"))
+
+
+def render_payload(xml):
+    """
+    Renders an XML payload for humans, with bank account data redacted and truncated to
+    ``PAYLOAD_LOG_LIMIT`` characters.
+    """
+    if isinstance(xml, bytes):
+        xml = xml.decode(errors="replace")
+    xml = _redacted_elements.sub(_redact, xml)
+    if len(xml) > PAYLOAD_LOG_LIMIT:
+        xml = xml[:PAYLOAD_LOG_LIMIT] + "… ({} characters omitted)".format(
+            len(xml) - PAYLOAD_LOG_LIMIT
+        )
+    return xml
+
+
+class LoggedPayload:
+    """
+    Wraps a payload passed as an argument to a logging call, so it is only rendered if the
+    message is actually emitted.
+    """
+
+    __slots__ = ("xml",)
 
-class SofortError(Exception):
     def __init__(self, xml):
-        errors = etree.fromstring(xml)
-        strl = []
-        for e in errors.xpath("error"):
-            strl.append(e.xpath("message")[0].text)
-        self.message = ", ".join(strl)
+        self.xml = xml
+
+    def __str__(self):
+        return render_payload(self.xml)
+
+
+def _el(tag, value):
+    return "<{0}>{1}</{0}>".format(tag, "" if value is None else escape(str(value)))
+
+
+def _first(xpath, root):
+    r = xpath(root)
+    return r[0] if r else None
+
+
+def format_value(value):
+    """
+    Renders a value of a parsed response the way Sofort sent it.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value is None:
+        return None
+    return str(value)
+
+
+def _convert(converter, tag, text):
+    if text is None:
+        return None
+    try:
+        value = converter(text)
+    except (ValueError, InvalidOperation):
+        value = None
+    if value is None:
+        raise SofortError(message="Invalid value received for {}: {}".format(tag, text))
+    return value
+
+
+def _parse(xml):
+    try:
+        root = etree.fromstring(xml)
+    except XMLSyntaxError:
+        raise SofortError(
+            message="Invalid XML received: " + render_payload(xml)
+        )
+    if root.tag == "errors":
+        raise SofortError(xml)
+    return root
+
+
+class SofortError(Exception):
+    def __init__(self, xml=None, message=None):
+        if message is None:
+            message = ", ".join(_xpath_error_messages(etree.fromstring(xml)))
+        self.message = message
 
     def __str__(self):
         return self.message
@@ -53,101 +190,68 @@ class MultiPay:
         self.timeout = timeout
 
     def to_xml(self):
-        root = etree.Element("multipay")
-
-        el = etree.Element("project_id")
-        el.text = str(self.project_id)
-        root.append(el)
-
-        el = etree.Element("interface_version")
-        el.text = "pretix_{}/Sofort_{}".format(pversion, __version__)
-        root.append(el)
-
-        el = etree.Element("amount")
-        el.text = str(self.amount)
-        root.append(el)
-
-        el = etree.Element("timeout")
-        el.text = str(self.timeout)
-        root.append(el)
-
-        el = etree.Element("currency_code")
-        el.text = self.currency_code
-        root.append(el)
+        parts = [
+            XML_HEADER,
+            "<multipay>",
+            _el("project_id", self.project_id),
+            _INTERFACE_VERSION_ELEMENT,
+            _el("amount", self.amount),
+            _el("timeout", self.timeout),
+            _el("currency_code", self.currency_code),
+        ]
 
         if self.reasons:
-            el = etree.Element("reasons")
-            for r in self.reasons:
-                rel = etree.Element("reason")
-                rel.text = str(r)
-                el.append(rel)
-            root.append(el)
-
-        el = etree.Element("user_variables")
-        for r in self.user_variables:
-            rel = etree.Element("user_variables")
-            rel.text = str(r)
-            el.append(rel)
-        root.append(el)
+            parts.append("<reasons>")
+            parts.extend(_el("reason", r) for r in self.reasons)
+            parts.append("</reasons>")
+
+        parts.append("<user_variables>")
+        parts.extend(_el("user_variables", r) for r in self.user_variables)
+        parts.append("</user_variables>")
 
         if self.success_url:
-            el = etree.Element("success_url")
-            el.text = self.success_url
-            root.append(el)
+            parts.append(_el("success_url", self.success_url))
 
-        el = etree.Element("success_link_redirect")
-        el.text = str(self.success_link_redirect)
-        root.append(el)
+        parts.append(_el("success_link_redirect", self.success_link_redirect))
 
         if self.abort_url:
-            el = etree.Element("abort_url")
-            el.text = self.abort_url
-            root.append(el)
+            parts.append(_el("abort_url", self.abort_url))
 
         if self.notification_urls:
-            el = etree.Element("notification_urls")
-            for r in self.notification_urls:
-                rel = etree.Element("notification_url")
-                rel.text = str(r)
-                rel.set("notify_on", "received,loss,refunded,pending")
-                el.append(rel)
-            root.append(el)
+            parts.append("<notification_urls>")
+            parts.extend(
+                _NOTIFICATION_URL_ELEMENT.format(escape(str(r)))
+                for r in self.notification_urls
+            )
+            parts.append("</notification_urls>")
 
-        root.append(etree.Element("su"))
+        parts.append("<su/>")
 
         if self.beneficiary_identifier and self.beneficiary_country_code:
-            el = etree.Element("beneficiary")
-            rel = etree.Element("identifier")
-            rel.text = self.beneficiary_identifier
-            el.append(rel)
-            rel = etree.Element("country_code")
-            rel.text = self.beneficiary_country_code
-            el.append(rel)
-            root.append(el)
-
-        xml = b'<?xml version="1.0" encoding="UTF-8" ?>\n' + etree.tostring(
-            root, pretty_print=True
-        )
-        logger.debug("Generated XML: " + xml.decode())
+            parts.append("<beneficiary>")
+            parts.append(_el("identifier", self.beneficiary_identifier))
+            parts.append(_el("country_code", self.beneficiary_country_code))
+            parts.append("</beneficiary>")
+
+        parts.append("</multipay>")
+        xml = "".join(parts).encode()
+        logger.debug("Generated XML: %s", LoggedPayload(xml))
         return xml
 
 
 class NewTransaction:
+    __slots__ = ("transaction", "payment_url")
+
     def __init__(self, transaction, payment_url):
         self.transaction = transaction
         self.payment_url = payment_url
 
     @classmethod
     def from_xml(cls, xml):
-        try:
-            root = etree.fromstring(xml)
-        except XMLSyntaxError:
-            raise SofortError("Invalid XML received: " + xml.decode())
-        if root.tag == "errors":
-            raise SofortError(xml)
+        root = _parse(xml)
         return cls(
-            transaction=root.xpath("/new_transaction/transaction")[0].text,
-            payment_url=root.xpath("/new_transaction/payment_url")[0].text,
+            transaction=_first(_xpath_new_transaction, root),
+            payment_url=_first(_xpath_payment_url, root),
         )
 
 
@@ -156,22 +260,22 @@ class TransactionRequest:
         self.transactions = transactions
 
     def to_xml(self):
-        root = etree.Element("transaction_request")
-        root.set("version", "2")
-
-        for t in self.transactions:
-            el = etree.Element("transaction")
-            el.text = str(t)
-            root.append(el)
-
-        xml = b'<?xml version="1.0" encoding="UTF-8" ?>\n' + etree.tostring(
-            root, pretty_print=True
-        )
-        logger.debug("Generated XML: " + xml.decode())
+        xml = (
+            XML_HEADER
+            + '<transaction_request version="2">'
+            + "".join(_el("transaction", t) for t in self.transactions)
+            + "</transaction_request>"
+        ).encode()
+        logger.debug("Generated XML: %s", LoggedPayload(xml))
         return xml
 
 
 class TransactionDetails:
+    """
+    The details of a transaction as reported by Sofort. Amounts are ``Decimal`` and points in time are
+    ``datetime`` objects, ``text`` and ``to_data`` return them the way Sofort sent them.
+    """
+
     SIMPLE_FIELDS = (
         "project_id",
         "transaction",
@@ -190,87 +294,150 @@ class TransactionDetails:
         "exchange_rate",
     )
     MORE_FIELDS = ("reasons", "user_variables", "sender", "recipient", "costs")
-
-    def to_data(self, no_sepa_data=False):
-        d = {t: getattr(self, t) for t in self.SIMPLE_FIELDS}
-        d.update({t: getattr(self, t) for t in self.MORE_FIELDS})
+    CONVERTERS = {
+        "time": parse_datetime,
+        "status_modified": parse_datetime,
+        "amount": Decimal,
+        "amount_refunded": Decimal,
+        "exchange_rate": Decimal,
+    }
+    __slots__ = SIMPLE_FIELDS + MORE_FIELDS + ("_texts", "_redacted")
+
+    def __init__(self, **kwargs):
+        for f in self.SIMPLE_FIELDS:
+            setattr(self, f, kwargs.get(f))
+        self.reasons = kwargs.get("reasons", [])
+        self.user_variables = kwargs.get("user_variables", [])
+        self.sender = kwargs.get("sender", {})
+        self.recipient = kwargs.get("recipient", {})
+        self.costs = kwargs.get("costs", {})
+        self._texts = {}
+        self._redacted = None
+
+    def text(self, field):
+        """
+        Returns the value of ``field`` the way Sofort sent it.
+        """
+        if field in self._texts:
+            return self._texts[field]
+        return format_value(getattr(self, field))
+
+    def _build_data(self, no_sepa_data):
+        d = {t: self.text(t) for t in self.SIMPLE_FIELDS}
+        d["reasons"] = list(self.reasons)
+        d["user_variables"] = list(self.user_variables)
         if no_sepa_data:
-            if "sender" in d["recipient"]:
-                del d["sender"]["account_number"]
-            if d["sender"].get("iban"):
-                d["sender"]["iban"] = (
-                    d["sender"]["iban"][:4]
-                    + ("*" * (len(d["sender"]["iban"]) - 8))
-                    + d["sender"]["iban"][-4:]
-                )
-            if "account_number" in d["recipient"]:
-                del d["recipient"]["account_number"]
-            if d["recipient"].get("iban"):
-                d["recipient"]["iban"] = (
-                    d["recipient"]["iban"][:4]
-                    + ("*" * (len(d["recipient"]["iban"]) - 8))
-                    + d["recipient"]["iban"][-4:]
-                )
+            d["sender"] = _redact_account(self.sender)
+            d["recipient"] = _redact_account(self.recipient)
+        else:
+            d["sender"] = dict(self.sender)
+            d["recipient"] = dict(self.recipient)
+        d["costs"] = dict(self.costs)
         return d
 
+    def to_data(self, no_sepa_data=False):
+        """
+        Returns the details as plain values. The redacted dictionary is shared between calls, don't modify it.
+        """
+        if not no_sepa_data:
+            return self._build_data(False)
+        if self._redacted is None:
+            self._redacted = self._build_data(True)
+        return self._redacted
+
     def to_json(self, no_sepa_data=False):
-        return json.dumps(self.to_data(no_sepa_data))
+        return _json_encoder.encode(self.to_data(no_sepa_data))
+
+    @classmethod
+    def from_element(cls, td):
+        tdo = cls()
+        converters = cls.CONVERTERS
+        for el in td:
+            tag = el.tag
+            if tag in _SIMPLE_FIELDS:
+                if tag in converters:
+                    setattr(tdo, tag, _convert(converters[tag], tag, el.text))
+                    tdo._texts[tag] = el.text
+                else:
+                    setattr(tdo, tag, el.text)
+            elif tag == "reasons":
+                tdo.reasons = [r.text for r in el if r.tag == "reason"]
+            elif tag == "user_variables":
+                tdo.user_variables = [r.text for r in el if r.tag == "user_variable"]
+            elif tag in ("sender", "recipient", "costs"):
+                setattr(tdo, tag, {r.tag: r.text for r in el})
+        return tdo
+
+
+_SIMPLE_FIELDS = frozenset(TransactionDetails.SIMPLE_FIELDS)
 
 
 class Transactions:
+    __slots__ = ("details",)
+
     def __init__(self, details):
         self.details = details
 
     @classmethod
     def from_xml(cls, xml):
+        return cls(details=list(cls.iter_xml(xml)))
+
+    @classmethod
+    def iter_xml(cls, xml):
+        """
+        Parses a transactions response incrementally, yielding one ``TransactionDetails`` at a time.
+        """
+        context = etree.iterparse(
+            BytesIO(xml), events=("end",), tag="transaction_details"
+        )
         try:
-            root = etree.fromstring(xml)
+            for _, el in context:
+                parent = el.getparent()
+                if parent.tag != "transactions" or parent.getparent() is not None:
+                    continue
+                yield TransactionDetails.from_element(el)
+                el.clear()
+                while el.getprevious() is not None:
+                    del parent[0]
         except XMLSyntaxError:
-            raise SofortError("Invalid XML received: " + xml.decode())
-        if root.tag == "errors":
+            raise SofortError(
+                message="Invalid XML received: " + render_payload(xml)
+            )
+        if context.root.tag == "errors":
             raise SofortError(xml)
 
-        tdos = []
-        for td in root.xpath("/transactions/transaction_details"):
-            tdo = TransactionDetails()
-            for f in TransactionDetails.SIMPLE_FIELDS:
-                setattr(tdo, f, td.xpath("{}".format(f))[0].text)
-
-            tdo.reasons = [r.text for r in td.xpath("reasons/reason")]
-            tdo.user_variables = [
-                r.text for r in td.xpath("user_variables/user_variable")
-            ]
-            tdo.sender = {r.tag: r.text for r in td.xpath("sender")[0]}
-            tdo.recipient = {r.tag: r.text for r in td.xpath("recipient")[0]}
-            tdo.costs = {r.tag: r.text for r in td.xpath("costs")[0]}
-            tdos.append(tdo)
-
-        return cls(details=tdos)
-
 
 class StatusNotification:
+    __slots__ = ("transaction", "time")
+
     def __init__(self, transaction, time):
         self.transaction = transaction
         self.time = time
 
     @classmethod
     def from_xml(cls, xml):
-        try:
-            root = etree.fromstring(xml)
-        except XMLSyntaxError:
-            raise SofortError("Invalid XML received: " + xml.decode())
-        if root.tag == "errors":
-            raise SofortError(xml)
-
+        root = _parse(xml)
         return cls(
-            transaction=root.xpath("/status_notification/transaction")[0].text,
-            time=root.xpath("/status_notification/time")[0].text,
+            transaction=_first(_xpath_notification_transaction, root),
+            time=_convert(
+                parse_datetime, "time", _first(_xpath_notification_time, root)
+            ),
         )
 
 
 class Refund:
+    FIELDS = ("transaction", "amount", "comment", "reason_1", "reason_2", "status")
+    __slots__ = FIELDS + ("error",)
+
     def __init__(
-        self, transaction, amount, comment, reason_1, reason_2, status="created"
+        self,
+        transaction,
+        amount,
+        comment,
+        reason_1,
+        reason_2,
+        status="created",
+        error=None,
     ):
         self.transaction = transaction
         self.amount = amount
@@ -278,71 +445,50 @@ class Refund:
         self.reason_1 = reason_1
         self.reason_2 = reason_2
         self.status = status
+        self.error = error
+
+
+_REFUND_FIELDS = frozenset(Refund.FIELDS)
 
 
 class Refunds:
+    __slots__ = ("refunds",)
+
     def __init__(self, refunds):
         self.refunds = refunds
 
     def to_xml(self):
-        root = etree.Element("refunds")
-        root.set("version", "3")
-
+        parts = [XML_HEADER, '<refunds version="3">']
         for t in self.refunds:
-            el = etree.Element("refund")
-
-            rel = etree.Element("transaction")
-            rel.text = t.transaction
-            el.append(rel)
-
-            rel = etree.Element("amount")
-            rel.text = str(t.amount)
-            el.append(rel)
-
-            rel = etree.Element("comment")
-            rel.text = t.comment
-            el.append(rel)
-
-            rel = etree.Element("reason_1")
-            rel.text = t.reason_1
-            el.append(rel)
-
-            rel = etree.Element("reason_2")
-            rel.text = t.reason_2
-            el.append(rel)
-
-            root.append(el)
-
-        xml = b'<?xml version="1.0" encoding="UTF-8" ?>\n' + etree.tostring(
-            root, pretty_print=True
-        )
-        logger.debug("Generated XML: " + xml.decode())
+            parts.append("<refund>")
+            parts.append(_el("transaction", t.transaction))
+            parts.append(_el("amount", t.amount))
+            parts.append(_el("comment", t.comment))
+            parts.append(_el("reason_1", t.reason_1))
+            parts.append(_el("reason_2", t.reason_2))
+            parts.append("</refund>")
+        parts.append("</refunds>")
+        xml = "".join(parts).encode()
+        logger.debug("Generated XML: %s", LoggedPayload(xml))
         return xml
 
     @classmethod
     def from_xml(cls, xml):
-        try:
-            root = etree.fromstring(xml)
-        except XMLSyntaxError:
-            raise SofortError("Invalid XML received: " + xml.decode())
-        if root.tag == "errors":
-            raise SofortError(xml)
+        """
+        Parses a refunds response. Rejected refunds don't raise, they have ``status`` ``"error"`` and ``error`` set.
+        """
+        root = _parse(xml)
 
         tdos = []
-        for td in root.xpath("/refunds/refund"):
-            kwargs = {}
-            for f in (
-                "transaction",
-                "amount",
-                "comment",
-                "reason_1",
-                "reason_2",
-                "status",
-            ):
-                kwargs[f] = td.xpath("{}".format(f))[0].text
-            if kwargs.get("status") == "error":
-                raise SofortError(etree.tostring(td.xpath("errors")[0]))
-            tdo = Refund(**kwargs)
-            tdos.append(tdo)
+        for td in _xpath_refunds(root):
+            kwargs = dict.fromkeys(Refund.FIELDS)
+            for el in td:
+                if el.tag == "amount":
+                    kwargs["amount"] = _convert(Decimal, "amount", el.text)
+                elif el.tag in _REFUND_FIELDS:
+                    kwargs[el.tag] = el.text
+                elif el.tag == "errors":
+                    kwargs["error"] = ", ".join(_xpath_error_messages(el))
+            tdos.append(Refund(**kwargs))
 
         return cls(tdos)
@@ -0,0 +1,261 @@
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment, OrderRefund
+from pretix.base.payment import PaymentException
+from pretix.base.services.tasks import EventTask
+from pretix.base.settings import GlobalSettingsObject
+from pretix.celery_app import app
+from pretix.helpers.database import OF_SELF
+
+from . import metrics
+from .models import QueuedSofortRefund, ReferencedSofortTransaction
+from .payment import TRANSACTION_REQUEST_BATCH_SIZE, Sofort
+
+logger = logging.getLogger(__name__)
+
+# Seconds we wait for more refunds to come in before submitting them
+REFUND_BATCH_DELAY = 30
+# Seconds after which the claim of a run on the refunds of an event expires in case the run died
+REFUND_LOCK_TIMEOUT = 3600
+
+# Payments younger than this are left to the webhook and the returning customer
+SWEEP_MIN_AGE = timedelta(minutes=15)
+# Payments older than this are not checked anymore
+SWEEP_MAX_AGE = timedelta(days=14)
+# A transaction is looked up again after this share of the age of its payment, so abandoned payments are
+# checked less and less often, but at least every SWEEP_MAX_INTERVAL
+SWEEP_BACKOFF = 0.25
+SWEEP_MAX_INTERVAL = timedelta(days=1)
+# Maximum number of transactions looked up at Sofort per run
+SWEEP_MAX_TRANSACTIONS = 2000
+# Seconds after which a run stops starting new lookups
+SWEEP_TIME_BUDGET = 60
+SWEEP_CURSOR_KEY = "sofort_sweep_cursor"
+
+
+def pending_transactions():
+    """
+    Returns all Sofort transactions whose payment has not yet reached a final state. Transactions not
+    linked to a payment yet are left to the ``sofort_backfill_payments`` command.
+    """
+    return ReferencedSofortTransaction.objects.filter(
+        payment__provider__startswith="sofort",
+        payment__state__in=(
+            OrderPayment.PAYMENT_STATE_CREATED,
+            OrderPayment.PAYMENT_STATE_PENDING,
+        ),
+    ).select_related("order", "order__event", "payment")
+
+
+def reconcile_transactions(rsos):
+    """
+    Fetches and applies the state of many transactions, batched per credential set. Returns the number of
+    state transitions and the transactions that could be looked up.
+    """
+    providers = {}
+    groups = defaultdict(list)
+    for rso in rsos:
+        prov = providers.get(rso.order.event_id)
+        if prov is None:
+            prov = providers[rso.order.event_id] = Sofort(rso.order.event)
+        groups[(prov.config.customer_id, prov.config.api_key)].append((prov, rso))
+
+    changed = 0
+    processed = []
+    for group in groups.values():
+        try:
+            details = group[0][0]._fetch_transaction_details(
+                [rso.reference for prov, rso in group]
+            )
+        except PaymentException:
+            # Already logged, the other credential sets might still work
+            continue
+
+        for prov, rso in group:
+            processed.append(rso)
+            td = details.get(rso.reference)
+            if not td:
+                continue
+            try:
+                if prov._handle_transaction_details(rso, td):
+                    changed += 1
+            except PaymentException as e:
+                logger.warning(
+                    "Could not apply Sofort state to transaction {}: {}".format(
+                        rso.reference, e
+                    )
+                )
+    return changed, processed
+
+
+@app.task(base=EventTask, bind=True, max_retries=5, default_retry_delay=60)
+def process_notification(self, event, rso):
+    rso = ReferencedSofortTransaction.objects.select_related(
+        "order", "order__event", "payment"
+    ).get(pk=rso, order__event=event)
+    try:
+        with metrics.span("process_transaction"):
+            Sofort(event)._process_transaction(rso, rso.notification_time)
+    except PaymentException as e:
+        # The notification stays marked as pending, so it is picked up again even if we run out of retries
+        raise self.retry(exc=e)
+
+    # Only clear the flag if no newer notification has been recorded in the meantime
+    ReferencedSofortTransaction.objects.filter(
+        pk=rso.pk, notification_time=rso.notification_time
+    ).update(notification_pending=False)
+
+
+def queued_refunds():
+    """
+    Returns all refunds that wait for a batched submission and have not been claimed by a run yet.
+    """
+    return QueuedSofortRefund.objects.filter(
+        state=QueuedSofortRefund.STATE_QUEUED,
+        refund__state=OrderRefund.REFUND_STATE_TRANSIT,
+    )
+
+
+def schedule_refund_submission(event):
+    if cache.add(
+        "pretix_sofort_refunds_scheduled_{}".format(event.pk),
+        True,
+        timeout=REFUND_BATCH_DELAY * 2,
+    ):
+        submit_refunds.apply_async(
+            kwargs={"event": event.pk}, countdown=REFUND_BATCH_DELAY
+        )
+
+
+@app.task(base=EventTask)
+def submit_refunds(event):
+    # Refunds queued from now on need another run
+    cache.delete("pretix_sofort_refunds_scheduled_{}".format(event.pk))
+    lock_key = "pretix_sofort_refunds_submitting_{}".format(event.pk)
+    if not cache.add(lock_key, True, timeout=REFUND_LOCK_TIMEOUT):
+        # Another run is busy with this event, refunds it did not claim are submitted after it
+        schedule_refund_submission(event)
+        return
+
+    try:
+        # Claim the refunds before talking to Sofort, so no other run can submit them again, even if
+        # this one dies before it recorded the outcome
+        with transaction.atomic():
+            claimed = list(
+                queued_refunds()
+                .filter(refund__order__event=event)
+                .select_for_update(skip_locked=True, of=OF_SELF)
+                .values_list("pk", flat=True)
+            )
+            QueuedSofortRefund.objects.filter(pk__in=claimed).update(
+                state=QueuedSofortRefund.STATE_SUBMITTING, claimed=now()
+            )
+        refunds = list(
+            OrderRefund.objects.filter(sofort_queue__pk__in=claimed)
+            .select_related("order", "order__event", "payment")
+            .order_by("pk")
+        )
+        if refunds:
+            Sofort(event).execute_refunds(refunds)
+    finally:
+        cache.delete(lock_key)
+
+
+def report_abandoned_refunds():
+    """
+    Logs refunds on their order whose submission died before its outcome was recorded.
+    """
+    abandoned = QueuedSofortRefund.objects.filter(
+        state=QueuedSofortRefund.STATE_SUBMITTING,
+        claimed__lt=now() - timedelta(seconds=REFUND_LOCK_TIMEOUT),
+    ).select_related("refund", "refund__order", "refund__order__event")
+    for queued in abandoned:
+        with transaction.atomic():
+            if not QueuedSofortRefund.objects.filter(
+                pk=queued.pk, state=QueuedSofortRefund.STATE_SUBMITTING
+            ).update(state=QueuedSofortRefund.STATE_UNKNOWN):
+                continue
+            refund = queued.refund
+            logger.error(
+                "Refund {} might or might not have been submitted to Sofort.".format(refund.full_id)
+            )
+            refund.order.log_action(
+                "pretix_sofort.sofort.refund_unknown",
+                {"local_id": refund.local_id, "provider": refund.provider},
+            )
+
+
+def _schedule_next_checks(rsos):
+    t = now()
+    for rso in rsos:
+        interval = (t - rso.payment.created) * SWEEP_BACKOFF
+        rso.next_check = t + min(max(interval, SWEEP_MIN_AGE), SWEEP_MAX_INTERVAL)
+    ReferencedSofortTransaction.objects.bulk_update(rsos, ["next_check"])
+
+
+@app.task
+@scopes_disabled()
+def sweep_stale_payments():
+    """
+    Checks payments still pending a while after they were started, in case their notification got lost.
+    Every run continues where the last one stopped.
+    """
+    deadline = time.monotonic() + SWEEP_TIME_BUDGET
+    gs = GlobalSettingsObject()
+    cursor = gs.settings.get(SWEEP_CURSOR_KEY, as_type=int, default=0)
+    checked = 0
+    changed = 0
+
+    # Notifications recorded by the webhook whose background processing got lost
+    stale = list(
+        ReferencedSofortTransaction.objects.filter(
+            notification_pending=True,
+            notification_time__lt=now() - SWEEP_MIN_AGE,
+        ).select_related("order", "order__event", "payment")[
+            :TRANSACTION_REQUEST_BATCH_SIZE
+        ]
+    )
+    if stale:
+        stale_changed, processed = reconcile_transactions(stale)
+        changed += stale_changed
+        checked += len(processed)
+        # Transactions we could not look up stay pending for the next run
+        ReferencedSofortTransaction.objects.filter(
+            pk__in=[rso.pk for rso in processed]
+        ).update(notification_pending=False)
+
+    while checked < SWEEP_MAX_TRANSACTIONS and time.monotonic() < deadline:
+        rsos = list(
+            pending_transactions()
+            .filter(
+                Q(next_check__isnull=True) | Q(next_check__lte=now()),
+                pk__gt=cursor,
+                payment__created__gte=now() - SWEEP_MAX_AGE,
+                payment__created__lt=now() - SWEEP_MIN_AGE,
+            )
+            .order_by("pk")[:TRANSACTION_REQUEST_BATCH_SIZE]
+        )
+        if not rsos:
+            # Reached the end, start from the beginning in the next run
+            cursor = 0
+            break
+        batch_changed, processed = reconcile_transactions(rsos)
+        _schedule_next_checks(processed)
+        changed += batch_changed
+        checked += len(processed)
+        cursor = rsos[-1].pk
+
+    gs.settings.set(SWEEP_CURSOR_KEY, cursor)
+    if checked:
+        logger.info(
+            "Checked {} Sofort transactions, {} of them changed.".format(
+                checked, changed
+            )
+        )
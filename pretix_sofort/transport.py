@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from requests import ConnectionError, HTTPError, RequestException, Session
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import metrics
+
+API_URL = settings.CONFIG_FILE.get(
+    "sofort", "api_url", fallback="https://api.sofort.com/api/xml"
+)
+POOL_SIZE = settings.CONFIG_FILE.getint("sofort", "pool_size", fallback=10)
+CONNECT_TIMEOUT = settings.CONFIG_FILE.getint("sofort", "connect_timeout", fallback=5)
+READ_TIMEOUT = settings.CONFIG_FILE.getint("sofort", "read_timeout", fallback=30)
+
+# Number of consecutive failed calls with the same credential set, each within BREAKER_WINDOW seconds of the
+# previous one, after which we stop calling Sofort with it
+BREAKER_THRESHOLD = 10
+BREAKER_WINDOW = 60
+# Seconds until the first probe call after the circuit opened. Doubles with every failed probe.
+BREAKER_COOLDOWN = 15
+BREAKER_MAX_COOLDOWN = 300
+# Additional attempts for idempotent calls, and the base delay between them in seconds
+RETRIES = 2
+RETRY_DELAY = 0.25
+
+logger = logging.getLogger(__name__)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _reset_sessions():
+    # Pooled connections must never be shared between a parent process and its forked workers, as
+    # both would then read from and write to the same sockets.
+    global _sessions_lock
+    _sessions.clear()
+    _sessions_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_sessions)
+
+
+class _CountingPoolMixin:
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        # A connection without a socket connects (again) for the upcoming request
+        metrics.inc(
+            metrics.sofort_http_connections,
+            result="miss" if getattr(conn, "sock", None) is None else "hit",
+        )
+        return conn
+
+
+class _HTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _HTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _HTTPConnectionPool,
+            "https": _HTTPSConnectionPool,
+        }
+
+
+def get_session(customer_id, api_key):
+    """
+    Returns a keep-alive session for the given credential set, shared by all threads of the current process.
+    """
+    key = (customer_id, api_key)
+    s = _sessions.get(key)
+    if s is not None:
+        return s
+
+    with _sessions_lock:
+        s = _sessions.get(key)
+        if s is None:
+            s = Session()
+            s.auth = (customer_id, api_key)
+            s.headers.update(
+                {
+                    "Content-Type": "application/xml; charset=UTF-8",
+                    "Accept": "application/xml; charset=UTF-8",
+                }
+            )
+            adapter = _CountingAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _sessions[key] = s
+    return s
+
+
+class SofortUnavailable(RequestException):
+    pass
+
+
+def _breaker_key(customer_id, url):
+    """
+    Returns the prefix of the cache keys of the circuit breaker of a credential set.
+    """
+    return "pretix_sofort_breaker_{}".format(
+        hashlib.sha1("{}@{}".format(customer_id, url).encode()).hexdigest()
+    )
+
+
+def _check_circuit(breaker):
+    """
+    Raises ``SofortUnavailable`` while the circuit is open. Returns whether this call is the single probe let
+    through after the cooldown, and whether there are recent failures.
+    """
+    state = cache.get_many([breaker + "_open_until", breaker + "_failures"])
+    open_until = state.get(breaker + "_open_until")
+    failing = bool(state.get(breaker + "_failures"))
+    if not open_until:
+        return False, failing
+    if open_until > time.time() or not cache.add(
+        breaker + "_probe", True, timeout=CONNECT_TIMEOUT + READ_TIMEOUT
+    ):
+        raise SofortUnavailable("Sofort is currently unavailable.")
+    return True, failing
+
+
+def _record_failure(breaker, probe):
+    cache.add(breaker + "_failures", 0, timeout=BREAKER_WINDOW)
+    try:
+        failures = cache.incr(breaker + "_failures")
+    except ValueError:  # expired in the meantime
+        failures = 1
+    else:
+        cache.touch(breaker + "_failures", BREAKER_WINDOW)
+    if not probe and failures < BREAKER_THRESHOLD:
+        return
+
+    trips = cache.get(breaker + "_trips", 0)
+    cooldown = min(BREAKER_COOLDOWN * 2**trips, BREAKER_MAX_COOLDOWN)
+    logger.warning(
+        "Sofort API failing, not calling it for {} seconds.".format(cooldown)
+    )
+    cache.set(
+        breaker + "_open_until",
+        time.time() + cooldown,
+        timeout=BREAKER_MAX_COOLDOWN * 2,
+    )
+    cache.set(breaker + "_trips", trips + 1, timeout=BREAKER_MAX_COOLDOWN * 2)
+    cache.delete_many([breaker + "_failures", breaker + "_probe"])
+
+
+def _record_success(breaker, probe, failing):
+    # Any success ends a series of failures, only consecutive failures open the circuit
+    if probe:
+        logger.info("Sofort API is available again.")
+        cache.delete_many(
+            [
+                breaker + "_failures",
+                breaker + "_open_until",
+                breaker + "_trips",
+                breaker + "_probe",
+            ]
+        )
+    elif failing:
+        cache.delete(breaker + "_failures")
+
+
+def post(customer_id, api_key, payload, idempotent=False, url=API_URL):
+    """
+    Sends ``payload`` to the Sofort API. Idempotent calls are retried if no connection could be made. While
+    Sofort keeps failing, calls raise ``SofortUnavailable`` right away.
+    """
+    breaker = _breaker_key(customer_id, url)
+    attempts = 1 + RETRIES if idempotent else 1
+    for attempt in range(attempts):
+        probe, failing = _check_circuit(breaker)
+        try:
+            r = get_session(customer_id, api_key).post(
+                url, data=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+            )
+            if r.status_code >= 500:
+                raise HTTPError(response=r)
+        except RequestException as e:
+            _record_failure(breaker, probe)
+            if attempt + 1 >= attempts or not isinstance(e, ConnectionError):
+                raise
+            time.sleep(random.uniform(0, RETRY_DELAY * 2**attempt))
+        else:
+            _record_success(breaker, probe, failing)
+            return r
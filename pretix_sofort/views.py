@@ -1,38 +1,52 @@
 import hashlib
-import json
 import logging
 import urllib.parse
-from decimal import Decimal
+from django.conf import settings
 from django.contrib import messages
 from django.core import signing
-from django.db.models import Sum
 from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.shortcuts import redirect, render
 from django.utils.decorators import method_decorator
-from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django.views import View
 from django.views.decorators.clickjacking import xframe_options_exempt
 from django.views.decorators.csrf import csrf_exempt
-from pretix.base.models import Order, OrderPayment, OrderRefund, Quota
+from pretix.base.models import Order, OrderPayment
 from pretix.base.payment import PaymentException
 from pretix.multidomain.urlreverse import build_absolute_uri, eventreverse
 
-from . import sofort
+from . import metrics, sofort
 from .models import ReferencedSofortTransaction
-from .payment import Sofort
+from .payment import Sofort, order_hash
+from .tasks import process_notification
 
 logger = logging.getLogger("pretix_sofort")
 
+ASYNC_WEBHOOKS = settings.CONFIG_FILE.getboolean(
+    "sofort", "async_webhooks", fallback=False
+)
+
 
 @csrf_exempt
 def webhook(request, *args, **kwargs):
     try:
-        sn = sofort.StatusNotification.from_xml(request.body)
-        rso = ReferencedSofortTransaction.objects.select_related(
-            "order", "order__event"
-        ).get(reference=sn.transaction)
-        process_result(request, rso, sn.transaction, log=True, warn=False)
+        with metrics.span("status_notification_from_xml"):
+            sn = sofort.StatusNotification.from_xml(request.body)
+        with metrics.span("transaction_lookup"):
+            rso = ReferencedSofortTransaction.objects.select_related(
+                "order", "order__event", "payment"
+            ).get(reference=sn.transaction)
+        if ASYNC_WEBHOOKS:
+            # Only record the notification and leave the API call to a background task, so we don't keep
+            # a web worker busy while talking to Sofort.
+            rso.notification_time = sn.time
+            rso.notification_pending = True
+            rso.save(update_fields=["notification_time", "notification_pending"])
+            process_notification.apply_async(
+                kwargs={"event": rso.order.event_id, "rso": rso.pk}
+            )
+            return HttpResponse("OK")
+        process_result(request, rso, warn=False, notification_time=sn.time)
         return HttpResponse("OK")
     except PaymentException as e:
         logger.exception("Failure during sofort payment: {}".format(e.message))
@@ -77,102 +91,12 @@ def redirect_view(request, *args, **kwargs):
         return r
 
 
-def process_result(request, rso, transaction, log=False, warn=True):
-    s = Sofort(request.event)
-    r = sofort.TransactionRequest(transactions=[transaction])
+def process_result(request, rso, warn=True, notification_time=None):
+    with metrics.span("process_transaction"):
+        result = Sofort(request.event)._process_transaction(rso, notification_time)
 
-    try:
-        trans = sofort.Transactions.from_xml(s._api_call(r.to_xml()))
-    except sofort.SofortError as e:
-        logger.exception("Failure during sofort payment: {}".format(e.message))
-        raise PaymentException(_("Sofort reported an error: {}").format(e.message))
-    except IOError:
-        logger.exception("Failure during sofort payment.")
-        raise PaymentException(
-            _(
-                "We had trouble communicating with Sofort. Please try again and get in touch "
-                "with us if this problem persists."
-            )
-        )
-
-    if not rso.payment:
-        rso.payment = rso.order.payments.filter(
-            info__icontains=transaction,
-            provider__startswith="sofort",
-        ).last()
-        rso.save()
-
-    if not rso.payment:
-        rso.payment = rso.order.payments.create(
-            state=OrderPayment.PAYMENT_STATE_CREATED,
-            provider="sofort",
-            amount=trans.details[0]["amount"],
-            info=json.dumps({{"transaction": transaction, "status": "initiated"}}),
-        )
-        rso.save()
-
-    if trans.details:
-        td = trans.details[0]
-        rso.payment.info = td.to_json(no_sepa_data=True)
-        rso.payment.save(update_fields=["info"])
-        rso.order.log_action(
-            "pretix_sofort.sofort.event", data=td.to_data(no_sepa_data=True)
-        )
-
-        if td.status in (
-            "pending",
-            "received",
-            "untraceable",
-        ) and rso.payment.state in (
-            OrderPayment.PAYMENT_STATE_CREATED,
-            OrderPayment.PAYMENT_STATE_PENDING,
-            OrderPayment.PAYMENT_STATE_FAILED,
-        ):
-            try:
-                rso.payment.state = Order.STATUS_PENDING
-                rso.payment.confirm()
-                rso.payment.refresh_from_db()
-            except Quota.QuotaExceededException:
-                raise PaymentException(
-                    _(
-                        "Your payment could not be handled as the event sold out in the meantime. "
-                        "Please contact the organizer for more information."
-                    )
-                )
-        elif (
-            td.status == "refunded"
-            and rso.payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
-        ):
-            known_sum = rso.payment.refunds.filter(
-                state__in=(
-                    OrderRefund.REFUND_STATE_DONE,
-                    OrderRefund.REFUND_STATE_TRANSIT,
-                    OrderRefund.REFUND_STATE_CREATED,
-                    OrderRefund.REFUND_SOURCE_EXTERNAL,
-                )
-            ).aggregate(s=Sum("amount"))["s"] or Decimal("0.00")
-            total_refunded_amount = Decimal(td.amount_refunded)
-            if known_sum < total_refunded_amount:
-                rso.payment.create_external_refund(
-                    amount=total_refunded_amount - known_sum
-                )
-        elif td.status == "loss":
-            rso.payment.state = OrderPayment.PAYMENT_STATE_FAILED
-            rso.payment.save()
-            rso.payment.order.log_action(
-                "pretix.event.order.payment.failed",
-                {
-                    "local_id": rso.payment.local_id,
-                    "provider": rso.payment.provider,
-                    "info": str(td),
-                },
-            )
-            if rso.order.pending_sum > 0:
-                with transaction.atomic():
-                    rso.order.status = Order.STATUS_PENDING
-                    rso.order.save()
-                    rso.order.create_transactions()
-        elif warn:
+    if result["found"]:
+        if not result["handled"] and warn:
             messages.error(
                 request,
                 _("The payment process has failed. You can click below to try again."),
@@ -192,29 +116,38 @@ def process_result(request, rso, transaction, log=False, warn=True):
 class ReturnView(View):
     def dispatch(self, request, *args, **kwargs):
         try:
-            self.order = request.event.orders.get(code=kwargs["order"])
-            if (
-                hashlib.sha1(self.order.secret.lower().encode()).hexdigest()
-                != kwargs["hash"].lower()
-            ):
-                raise Http404()
-        except Order.DoesNotExist:
-            # Do a hash comparison as well to harden timing attacks
-            if (
-                "abcdefghijklmnopq".lower()
-                == hashlib.sha1("abcdefghijklmnopq".encode()).hexdigest()
-            ):
-                raise Http404()
-            else:
-                raise Http404()
+            # Customers tend to reload this page a lot, so the order, the transaction and its payment are
+            # loaded in a single query.
+            self.rso = ReferencedSofortTransaction.objects.select_related(
+                "order", "payment"
+            ).get(
+                order__event=request.event,
+                order__code=kwargs["order"],
+                reference=request.GET.get("transaction"),
+            )
+            self.order = self.rso.order
+        except ReferencedSofortTransaction.DoesNotExist:
+            self.rso = None
+            try:
+                self.order = request.event.orders.get(code=kwargs["order"])
+            except Order.DoesNotExist:
+                # Do a hash comparison as well to harden timing attacks
+                if (
+                    "abcdefghijklmnopq".lower()
+                    == hashlib.sha1("abcdefghijklmnopq".encode()).hexdigest()
+                ):
+                    raise Http404()
+                else:
+                    raise Http404()
+        if order_hash(self.order) != kwargs["hash"].lower():
+            raise Http404()
         return super().dispatch(request, *args, **kwargs)
 
-    @cached_property
-    def pprov(self):
-        return self.request.event.get_payment_providers()[self.order.payment_provider]
-
     def get(self, request, *args, **kwargs):
         if request.GET.get("state") in ("abort", "timeout"):
+            if self.rso and self.rso.payment:
+                # The next attempt to pay has to start a new transaction
+                Sofort(request.event).discard_payment_url(self.rso.payment, self.rso.reference)
             messages.error(
                 self.request,
                 _(
@@ -223,23 +156,23 @@ class ReturnView(View):
             )
             return self._redirect_to_order()
 
-        if self.order.status == Order.STATUS_PAID:
+        # Nothing left to ask Sofort about. Otherwise, repeated lookups are answered from the recent
+        # results kept by process_result.
+        if self.order.status == Order.STATUS_PAID or (
+            self.rso
+            and self.rso.payment
+            and self.rso.payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+        ):
             return self._redirect_to_order()
 
-        try:
-            rso = ReferencedSofortTransaction.objects.get(
-                reference=request.GET.get("transaction"), order=self.order
-            )
-        except ReferencedSofortTransaction.DoesNotExist:
+        if self.rso is None:
             messages.error(
                 self.request, _("Sorry, there was an error in the payment process.")
             )
             return redirect(eventreverse(self.request.event, "presale:event.index"))
 
         try:
-            process_result(
-                request, rso, request.GET.get("transaction"), log=False, warn=True
-            )
+            process_result(request, self.rso, warn=True)
         except PaymentException as e:
             messages.error(self.request, str(e))
         return self._redirect_to_order()
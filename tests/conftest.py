@@ -0,0 +1,209 @@
+import inspect
+import pytest
+from datetime import timedelta
+from decimal import Decimal
+from django.core.cache import cache
+from django.test import RequestFactory, override_settings
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from lxml import etree
+from pretix.base.models import Event, Order, OrderPayment, Organizer
+
+from pretix_sofort import cache as details_cache, transport
+from pretix_sofort.models import ReferencedSofortTransaction
+from pretix_sofort.views import webhook
+
+TRANSACTION_DETAILS = """<?xml version="1.0" encoding="UTF-8" ?>
+<transactions>
+    <transaction_details>
+        <project_id>12345</project_id>
+        <transaction>{transaction}</transaction>
+        <test>1</test>
+        <time>2010-04-14T19:01:08+02:00</time>
+        <status>{status}</status>
+        <status_reason>credited</status_reason>
+        <status_modified>{status_modified}</status_modified>
+        <payment_method>su</payment_method>
+        <language_code>de</language_code>
+        <amount>12.50</amount>
+        <amount_refunded>0.00</amount_refunded>
+        <currency_code>EUR</currency_code>
+        <reasons>
+            <reason>ABCDE-1</reason>
+            <reason>{transaction}</reason>
+        </reasons>
+        <user_variables>
+            <user_variable>ABCDE-1</user_variable>
+        </user_variables>
+        <sender>
+            <holder>Max Mustermann</holder>
+            <account_number>2345678</account_number>
+            <bank_code>00000</bank_code>
+            <bank_name>Demo Bank</bank_name>
+            <bic>SFRTDE20XXX</bic>
+            <iban>DE86000000002345678902</iban>
+            <country_code>DE</country_code>
+        </sender>
+        <recipient>
+            <holder>Event GmbH</holder>
+            <account_number>23456789</account_number>
+            <bank_code>00000</bank_code>
+            <bank_name>Demo Bank</bank_name>
+            <bic>SFRTDE20XXX</bic>
+            <iban>DE06000000000023456789</iban>
+            <country_code>DE</country_code>
+        </recipient>
+        <email_customer />
+        <phone_customer />
+        <exchange_rate>1.0000</exchange_rate>
+        <costs>
+            <fees>0.60</fees>
+            <currency_code>EUR</currency_code>
+            <exchange_rate>1.0000</exchange_rate>
+        </costs>
+    </transaction_details>
+</transactions>"""
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(fixturedef, request):
+    """
+    This hack automatically disables django-scopes for all fixtures which are not yield fixtures.
+    """
+    if inspect.isgeneratorfunction(fixturedef.func):
+        yield
+    else:
+        with scopes_disabled():
+            yield
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeSofort:
+    """
+    Replaces the Sofort API. Transaction requests are answered with the current ``status``, refunds are
+    accepted unless their amount is in ``rejected_amounts``.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.status = "received"
+        self.status_modified = now() - timedelta(minutes=5)
+        self.rejected_amounts = set()
+
+    def post(self, customer_id, api_key, payload, **kwargs):
+        self.calls.append(payload)
+        root = etree.fromstring(payload)
+        if root.tag == "refunds":
+            return FakeResponse(self.refunds(root))
+        if root.tag == "multipay":
+            return FakeResponse(self.new_transaction())
+        transaction = root.findtext("transaction")
+        return FakeResponse(
+            TRANSACTION_DETAILS.format(
+                transaction=transaction,
+                status=self.status,
+                status_modified=self.status_modified.isoformat(),
+            ).encode()
+        )
+
+    def new_transaction(self):
+        transaction = "12345-123456-{:08d}-ABCD".format(len(self.calls))
+        response = etree.Element("new_transaction")
+        etree.SubElement(response, "transaction").text = transaction
+        etree.SubElement(response, "payment_url").text = "https://www.sofort.com/payment/go/" + transaction
+        return etree.tostring(response, xml_declaration=True, encoding="UTF-8")
+
+    def refunds(self, root):
+        response = etree.Element("refunds")
+        for refund in root:
+            answer = etree.SubElement(response, "refund")
+            for tag in ("transaction", "amount", "comment", "reason_1", "reason_2"):
+                etree.SubElement(answer, tag).text = refund.findtext(tag)
+            if refund.findtext("amount") in self.rejected_amounts:
+                etree.SubElement(answer, "status").text = "error"
+                error = etree.SubElement(etree.SubElement(answer, "errors"), "error")
+                etree.SubElement(error, "code").text = "7009"
+                etree.SubElement(error, "message").text = "Refund amount too high."
+            else:
+                etree.SubElement(answer, "status").text = "ok"
+        return etree.tostring(response, xml_declaration=True, encoding="UTF-8")
+
+
+@pytest.fixture
+def shared_cache():
+    with override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    ):
+        yield
+        cache.clear()
+
+
+@pytest.fixture
+def sofort_api(monkeypatch):
+    fake = FakeSofort()
+    monkeypatch.setattr(transport, "post", fake.post)
+    with details_cache._local_lock:
+        details_cache._local.clear()
+    return fake
+
+
+@pytest.fixture
+def event():
+    organizer = Organizer.objects.create(name="Dummy", slug="dummy")
+    event = Event.objects.create(
+        organizer=organizer, name="Dummy", slug="dummy", date_from=now(), plugins="pretix_sofort", live=True
+    )
+    event.settings.set("payment_sofort__enabled", True)
+    event.settings.set("payment_sofort_customer_id", "12345")
+    event.settings.set("payment_sofort_api_key", "secret")
+    event.settings.set("payment_sofort_project_id", "12345")
+    return event
+
+
+@pytest.fixture
+def order(event):
+    return Order.objects.create(
+        code="FOOBAR", event=event, email="dummy@example.org", status=Order.STATUS_PENDING, datetime=now(),
+        expires=now() + timedelta(days=10), total=Decimal("12.50"),
+        sales_channel=event.organizer.sales_channels.get(identifier="web"),
+    )
+
+
+@pytest.fixture
+def payment(order):
+    return order.payments.create(
+        provider="sofort", amount=Decimal("12.50"), state=OrderPayment.PAYMENT_STATE_CREATED
+    )
+
+
+@pytest.fixture
+def rso(order, payment):
+    return ReferencedSofortTransaction.objects.create(
+        order=order, payment=payment, reference="12345-123456-00000001-ABCD"
+    )
+
+
+@pytest.fixture
+def notify():
+    """
+    Returns a function sending a status notification about ``rso`` to the webhook of ``event``.
+    """
+    def notify(event, rso, time):
+        request = RequestFactory().post(
+            "/",
+            "<status_notification><transaction>{}</transaction><time>{}</time></status_notification>".format(
+                rso.reference, time.isoformat()
+            ),
+            content_type="application/xml",
+        )
+        request.event = event
+        with scopes_disabled():
+            return webhook(request)
+
+    return notify
@@ -0,0 +1,88 @@
+import json
+import re
+import pytest
+from decimal import Decimal
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+
+from pretix_sofort.models import ReferencedSofortTransaction
+
+# Upper bound of the database queries of a status notification that links a legacy transaction to its payment
+# and confirms the payment, see test_queries.py
+MAX_QUERIES_LEGACY_WEBHOOK = 75
+
+
+def legacy_payment(order, transaction):
+    with scopes_disabled():
+        return order.payments.create(
+            provider="sofort", amount=Decimal("12.50"), state=OrderPayment.PAYMENT_STATE_CREATED,
+            info=json.dumps({"transaction": transaction, "status": "initiated"}),
+        )
+
+
+@pytest.mark.django_db
+def test_match_payment(order):
+    other = legacy_payment(order, "OTHER")
+    first = legacy_payment(order, "12345")
+    second = legacy_payment(order, "12345")
+    payments = [other, first, second]
+    assert ReferencedSofortTransaction.match_payment(payments, "12345") == second
+    assert ReferencedSofortTransaction.match_payment(payments, "OTHER") == other
+    assert ReferencedSofortTransaction.match_payment(payments, "UNKNOWN") is None
+    assert ReferencedSofortTransaction.match_payment([], "12345") is None
+
+
+@pytest.mark.django_db
+def test_match_payment_ignores_substrings(order):
+    # The lookup this replaces matched the transaction as a substring of the payment info
+    payment = legacy_payment(order, "12345-6789")
+    assert ReferencedSofortTransaction.match_payment([payment], "12345") is None
+
+
+@pytest.mark.django_db
+def test_backfill_links_legacy_rows(order):
+    payment = legacy_payment(order, "LEGACY-1")
+    legacy_payment(order, "LEGACY-OTHER")
+    linked = ReferencedSofortTransaction.objects.create(order=order, reference="LEGACY-1")
+    unmatched = ReferencedSofortTransaction.objects.create(order=order, reference="LEGACY-2")
+
+    call_command("sofort_backfill_payments", chunk_size=1)
+
+    linked.refresh_from_db()
+    unmatched.refresh_from_db()
+    assert linked.payment == payment
+    assert unmatched.payment is None
+
+
+@pytest.mark.django_db
+def test_backfill_keeps_linked_rows(order):
+    payment = legacy_payment(order, "LEGACY-1")
+    newer = legacy_payment(order, "LEGACY-1")
+    rso = ReferencedSofortTransaction.objects.create(order=order, payment=payment, reference="LEGACY-1")
+
+    call_command("sofort_backfill_payments")
+
+    rso.refresh_from_db()
+    assert rso.payment == payment != newer
+
+
+@pytest.mark.django_db
+def test_legacy_row_is_linked_without_substring_search(event, order, sofort_api, notify, django_assert_max_num_queries):
+    event.settings.mail_sales_channel_placed_paid = []
+    payment = legacy_payment(order, "12345-123456-00000001-ABCD")
+    rso = ReferencedSofortTransaction.objects.create(order=order, reference="12345-123456-00000001-ABCD")
+
+    with CaptureQueriesContext(connection) as ctx, django_assert_max_num_queries(MAX_QUERIES_LEGACY_WEBHOOK):
+        r = notify(event, rso, now())
+    assert r.status_code == 200
+    assert not [q for q in ctx.captured_queries if re.search(r'\."info"\S{0,10} I?LIKE ', q["sql"], re.IGNORECASE)]
+
+    with scopes_disabled():
+        rso.refresh_from_db()
+        payment.refresh_from_db()
+    assert rso.payment == payment
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
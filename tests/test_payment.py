@@ -0,0 +1,79 @@
+import pytest
+from django.test import RequestFactory
+from django_scopes import scopes_disabled
+from pretix.base.payment import PaymentException
+from requests import ConnectionError
+
+from pretix_sofort import payment as sofort_payment, transport
+from pretix_sofort.payment import Sofort
+
+
+@pytest.mark.django_db
+def test_config_reloaded_after_change_in_other_process(
+    event, shared_cache, django_capture_on_commit_callbacks
+):
+    assert Sofort(event).config.customer_id == "12345"
+    stale = sofort_payment._configs[event.pk]
+
+    with django_capture_on_commit_callbacks(execute=True):
+        event.settings.set("payment_sofort_customer_id", "54321")
+    # Another process still has the old settings in memory
+    sofort_payment._configs[event.pk] = stale
+
+    assert Sofort(event).config.customer_id == "54321"
+
+
+@pytest.fixture
+def request_(event):
+    request = RequestFactory().get("/")
+    request.event = event
+    request.session = {}
+    return request
+
+
+@pytest.mark.django_db
+def test_concurrent_attempts_share_transaction(event, payment, sofort_api, request_, monkeypatch):
+    with scopes_disabled():
+        provider = Sofort(event)
+        payment.info_data = {"status": "initiated", "transaction": "12345-123456-00000000-ABCD"}
+        payment.save(update_fields=["info"])
+        key = "{}:{}".format(payment.pk, payment.amount)
+
+        # The first attempt claimed the payment and is waiting for Sofort when the second one comes in
+        payment_url, _ = provider._claim_initiation(payment, key, wait=True)
+        assert payment_url is None
+        payment.refresh_from_db()
+        assert payment.info_data["status"] == "initiated"
+
+        first = []
+
+        def finish_first_attempt(seconds):
+            if not first:
+                first.append(provider._start_transaction(payment, key))
+
+        monkeypatch.setattr(sofort_payment.time, "sleep", finish_first_attempt)
+        assert provider.execute_payment(request_, payment) == first[0]
+        assert len(sofort_api.calls) == 1
+
+
+@pytest.mark.django_db
+def test_failed_attempt_releases_claim(event, payment, sofort_api, request_, monkeypatch):
+    with scopes_disabled():
+        provider = Sofort(event)
+        info = {"status": "initiated", "transaction": "12345-123456-00000000-ABCD"}
+        payment.info_data = info
+        payment.save(update_fields=["info"])
+
+        def fail(*args, **kwargs):
+            raise ConnectionError()
+
+        monkeypatch.setattr(transport, "post", fail)
+        with pytest.raises(PaymentException):
+            provider.execute_payment(request_, payment)
+        payment.refresh_from_db()
+        assert payment.info_data == info
+
+        # Another attempt does not wait for the failed one
+        monkeypatch.setattr(sofort_payment.time, "sleep", lambda seconds: pytest.fail("Waited for failed attempt"))
+        monkeypatch.setattr(transport, "post", sofort_api.post)
+        assert provider.execute_payment(request_, payment).startswith("https://www.sofort.com/")
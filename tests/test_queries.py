@@ -0,0 +1,79 @@
+import pytest
+from datetime import timedelta
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import LogEntry, Order, OrderPayment
+from pretix.multidomain.urlreverse import eventreverse
+
+from pretix_sofort.payment import order_hash
+
+# Upper bounds of the database queries of handling a request. A payment that changes its state includes the
+# queries of pretix confirming the payment and marking the order as paid.
+MAX_QUERIES_NEW_STATE_WEBHOOK = 70
+MAX_QUERIES_REPEATED_WEBHOOK = 5
+MAX_QUERIES_NEW_STATE_RETURN = 100
+MAX_QUERIES_REPEATED_RETURN = 35
+
+# Like in production, the settings of an event are kept in memory while the shared cache says they are current
+pytestmark = pytest.mark.usefixtures("shared_cache")
+
+
+@pytest.fixture(autouse=True)
+def no_paid_mail(event):
+    # Rendering the email has nothing to do with us, but takes lots of queries
+    event.settings.mail_sales_channel_placed_paid = []
+
+
+def return_url(event, rso):
+    return eventreverse(
+        event, "plugins:pretix_sofort:return", kwargs={"order": rso.order.code, "hash": order_hash(rso.order)}
+    ) + "?state=success&transaction=" + rso.reference
+
+
+@pytest.mark.django_db
+def test_webhook_new_state(event, rso, sofort_api, notify, django_assert_max_num_queries):
+    with django_assert_max_num_queries(MAX_QUERIES_NEW_STATE_WEBHOOK):
+        r = notify(event, rso, now())
+    assert r.status_code == 200
+    assert len(sofort_api.calls) == 1
+    with scopes_disabled():
+        rso.payment.refresh_from_db()
+        rso.order.refresh_from_db()
+        assert rso.payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+        assert rso.order.status == Order.STATUS_PAID
+
+
+@pytest.mark.django_db
+def test_webhook_repeated_notification(event, rso, sofort_api, notify, django_assert_max_num_queries):
+    notify(event, rso, now())
+    log_entries = LogEntry.objects.count()
+
+    # A newer notification makes us ask Sofort again, but nothing changed
+    with django_assert_max_num_queries(MAX_QUERIES_REPEATED_WEBHOOK):
+        r = notify(event, rso, now() + timedelta(minutes=1))
+    assert r.status_code == 200
+    assert len(sofort_api.calls) == 2
+    assert LogEntry.objects.count() == log_entries
+
+
+@pytest.mark.django_db
+def test_return_new_state(client, event, rso, sofort_api, django_assert_max_num_queries):
+    with django_assert_max_num_queries(MAX_QUERIES_NEW_STATE_RETURN):
+        r = client.get(return_url(event, rso))
+    assert r.status_code == 302
+    assert len(sofort_api.calls) == 1
+    with scopes_disabled():
+        rso.payment.refresh_from_db()
+        assert rso.payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+def test_return_repeated(client, event, rso, sofort_api, notify, django_assert_max_num_queries):
+    notify(event, rso, now())
+    log_entries = LogEntry.objects.count()
+
+    with django_assert_max_num_queries(MAX_QUERIES_REPEATED_RETURN):
+        r = client.get(return_url(event, rso))
+    assert r.status_code == 302
+    assert len(sofort_api.calls) == 1
+    assert LogEntry.objects.count() == log_entries
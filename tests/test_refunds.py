@@ -0,0 +1,178 @@
+import json
+import pytest
+from datetime import timedelta
+from decimal import Decimal
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment, OrderRefund
+
+from pretix_sofort import payment as sofort_payment, sofort, tasks
+from pretix_sofort.models import QueuedSofortRefund
+
+REFUNDS_RESPONSE = b"""<?xml version="1.0" encoding="UTF-8" ?>
+<refunds>
+    <refund>
+        <transaction>12345-123456-00000001-ABCD</transaction>
+        <amount>1.00</amount>
+        <comment>FOOBAR</comment>
+        <reason_1>DUMMY-FOOBAR</reason_1>
+        <reason_2 />
+        <status>ok</status>
+    </refund>
+    <refund>
+        <transaction>12345-123456-00000002-ABCD</transaction>
+        <amount>99.00</amount>
+        <comment>FOOBAR</comment>
+        <reason_1>DUMMY-FOOBAR</reason_1>
+        <reason_2 />
+        <status>error</status>
+        <errors>
+            <error>
+                <code>7009</code>
+                <message>Refund amount too high.</message>
+            </error>
+            <error>
+                <code>7010</code>
+                <message>Transaction not refundable.</message>
+            </error>
+        </errors>
+    </refund>
+    <refund>
+        <transaction>12345-123456-00000003-ABCD</transaction>
+        <amount>2.00</amount>
+        <comment>FOOBAR</comment>
+        <reason_1>DUMMY-FOOBAR</reason_1>
+        <reason_2 />
+        <status>ok</status>
+    </refund>
+</refunds>"""
+
+
+@pytest.fixture
+def confirmed_payment(order):
+    with scopes_disabled():
+        return order.payments.create(
+            provider="sofort", amount=Decimal("12.50"), state=OrderPayment.PAYMENT_STATE_CONFIRMED,
+            info=json.dumps({"transaction": "12345-123456-00000001-ABCD", "status": "received"}),
+        )
+
+
+def create_refunds(payment, *amounts):
+    with scopes_disabled():
+        return [
+            payment.order.refunds.create(
+                payment=payment, provider="sofort", amount=Decimal(amount),
+                state=OrderRefund.REFUND_STATE_CREATED, source=OrderRefund.REFUND_SOURCE_ADMIN,
+            )
+            for amount in amounts
+        ]
+
+
+def states(refunds):
+    with scopes_disabled():
+        for refund in refunds:
+            refund.refresh_from_db()
+    return [refund.state for refund in refunds]
+
+
+def test_refunds_from_xml_keeps_rejected_refunds():
+    refunds = sofort.Refunds.from_xml(REFUNDS_RESPONSE).refunds
+    assert [r.status for r in refunds] == ["ok", "error", "ok"]
+    assert [r.amount for r in refunds] == [Decimal("1.00"), Decimal("99.00"), Decimal("2.00")]
+    assert refunds[0].error is None
+    assert refunds[1].error == "Refund amount too high., Transaction not refundable."
+    assert refunds[2].transaction == "12345-123456-00000003-ABCD"
+
+
+@pytest.mark.django_db
+def test_execute_refunds_maps_results_to_refunds(event, confirmed_payment, sofort_api):
+    sofort_api.rejected_amounts = {"99.00"}
+    refunds = create_refunds(confirmed_payment, "1.00", "99.00", "2.00")
+
+    with scopes_disabled():
+        sofort_payment.Sofort(event).execute_refunds(refunds)
+
+    assert len(sofort_api.calls) == 1
+    assert states(refunds) == [
+        OrderRefund.REFUND_STATE_DONE, OrderRefund.REFUND_STATE_FAILED, OrderRefund.REFUND_STATE_DONE
+    ]
+    with scopes_disabled():
+        failed = confirmed_payment.order.all_logentries().get(action_type="pretix.event.order.refund.failed")
+    assert "Refund amount too high." in failed.parsed_data["error"]
+
+
+@pytest.mark.django_db
+def test_execute_refunds_records_every_batch(event, confirmed_payment, sofort_api, monkeypatch):
+    monkeypatch.setattr(sofort_payment, "REFUND_BATCH_SIZE", 2)
+    sofort_api.rejected_amounts = {"3.00"}
+    refunds = create_refunds(confirmed_payment, "1.00", "2.00", "3.00")
+
+    with scopes_disabled():
+        sofort_payment.Sofort(event).execute_refunds(refunds)
+
+    assert len(sofort_api.calls) == 2
+    assert states(refunds) == [
+        OrderRefund.REFUND_STATE_DONE, OrderRefund.REFUND_STATE_DONE, OrderRefund.REFUND_STATE_FAILED
+    ]
+
+
+@pytest.mark.django_db
+def test_queued_refunds_are_submitted_once(event, confirmed_payment, sofort_api, monkeypatch):
+    monkeypatch.setattr(sofort_payment, "BULK_REFUNDS", True)
+    monkeypatch.setattr(tasks.submit_refunds, "apply_async", lambda **kwargs: None)
+    sofort_api.rejected_amounts = {"99.00"}
+    refunds = create_refunds(confirmed_payment, "1.00", "99.00", "2.00")
+    provider = sofort_payment.Sofort(event)
+    with scopes_disabled():
+        for refund in refunds:
+            provider.execute_refund(refund)
+    assert states(refunds) == [OrderRefund.REFUND_STATE_TRANSIT] * 3
+    assert not sofort_api.calls
+
+    tasks.submit_refunds.apply(kwargs={"event": event.pk})
+    assert len(sofort_api.calls) == 1
+    assert states(refunds) == [
+        OrderRefund.REFUND_STATE_DONE, OrderRefund.REFUND_STATE_FAILED, OrderRefund.REFUND_STATE_DONE
+    ]
+    assert not QueuedSofortRefund.objects.exists()
+
+    tasks.submit_refunds.apply(kwargs={"event": event.pk})
+    assert len(sofort_api.calls) == 1
+
+
+@pytest.mark.django_db
+def test_claimed_refunds_are_not_submitted_again(event, confirmed_payment, sofort_api):
+    (refund,) = create_refunds(confirmed_payment, "1.00")
+    with scopes_disabled():
+        refund.state = OrderRefund.REFUND_STATE_TRANSIT
+        refund.save()
+    QueuedSofortRefund.objects.create(
+        refund=refund, state=QueuedSofortRefund.STATE_SUBMITTING, claimed=now()
+    )
+
+    tasks.submit_refunds.apply(kwargs={"event": event.pk})
+    assert not sofort_api.calls
+    assert states([refund]) == [OrderRefund.REFUND_STATE_TRANSIT]
+
+
+@pytest.mark.django_db
+def test_abandoned_refunds_are_reported(event, confirmed_payment):
+    recent, abandoned = create_refunds(confirmed_payment, "1.00", "2.00")
+    QueuedSofortRefund.objects.create(
+        refund=recent, state=QueuedSofortRefund.STATE_SUBMITTING, claimed=now()
+    )
+    QueuedSofortRefund.objects.create(
+        refund=abandoned, state=QueuedSofortRefund.STATE_SUBMITTING,
+        claimed=now() - timedelta(seconds=tasks.REFUND_LOCK_TIMEOUT + 1),
+    )
+
+    with scopes_disabled():
+        tasks.report_abandoned_refunds()
+        tasks.report_abandoned_refunds()
+        logged = list(
+            confirmed_payment.order.all_logentries().filter(action_type="pretix_sofort.sofort.refund_unknown")
+        )
+
+    assert [le.parsed_data["local_id"] for le in logged] == [abandoned.local_id]
+    assert QueuedSofortRefund.objects.get(refund=recent).state == QueuedSofortRefund.STATE_SUBMITTING
+    assert QueuedSofortRefund.objects.get(refund=abandoned).state == QueuedSofortRefund.STATE_UNKNOWN
@@ -0,0 +1,163 @@
+import pytest
+from datetime import datetime, timezone
+from decimal import Decimal
+from lxml import etree
+
+from pretix_sofort import sofort
+
+TRANSACTIONS = """<?xml version="1.0" encoding="UTF-8" ?>
+<transactions>
+    <transaction_details>
+        <transaction>12345-123456-00000001-ABCD</transaction>
+        <time>2010-04-14T19:01:08+02:00</time>
+        <status>received</status>
+        <status_modified>{status_modified}</status_modified>
+        <amount>12.50</amount>
+        <exchange_rate>1.0000</exchange_rate>
+    </transaction_details>
+</transactions>"""
+
+
+def element(tag, text=None, *children, **attrs):
+    el = etree.Element(tag, **attrs)
+    if text is not None:
+        el.text = str(text)
+    el.extend(children)
+    return el
+
+
+def canonical(xml):
+    return etree.tostring(etree.fromstring(xml), method="c14n")
+
+
+def assert_same_document(xml, root):
+    assert xml.startswith(sofort.XML_HEADER.encode())
+    assert canonical(xml) == etree.tostring(root, method="c14n")
+
+
+def test_multipay_to_xml():
+    mp = sofort.MultiPay(
+        project_id=1234,
+        amount=Decimal("23.00"),
+        currency_code="EUR",
+        reasons=["Order <FOOBAR> & more", "Tickets"],
+        user_variables=["dummy", "FOOBAR"],
+        success_url="https://example.org/return?a=1&b=2",
+        abort_url="https://example.org/abort",
+        notification_urls=["https://example.org/notify"],
+        beneficiary_identifier="Müller GmbH",
+        beneficiary_country_code="DE",
+    )
+    assert_same_document(
+        mp.to_xml(),
+        element(
+            "multipay",
+            None,
+            element("project_id", 1234),
+            element("interface_version", sofort.INTERFACE_VERSION),
+            element("amount", "23.00"),
+            element("timeout", 3600),
+            element("currency_code", "EUR"),
+            element(
+                "reasons",
+                None,
+                element("reason", "Order <FOOBAR> & more"),
+                element("reason", "Tickets"),
+            ),
+            element(
+                "user_variables",
+                None,
+                element("user_variables", "dummy"),
+                element("user_variables", "FOOBAR"),
+            ),
+            element("success_url", "https://example.org/return?a=1&b=2"),
+            element("success_link_redirect", 1),
+            element("abort_url", "https://example.org/abort"),
+            element(
+                "notification_urls",
+                None,
+                element(
+                    "notification_url",
+                    "https://example.org/notify",
+                    notify_on=sofort.NOTIFY_ON,
+                ),
+            ),
+            element("su"),
+            element(
+                "beneficiary",
+                None,
+                element("identifier", "Müller GmbH"),
+                element("country_code", "DE"),
+            ),
+        ),
+    )
+
+
+def test_transaction_request_to_xml():
+    assert_same_document(
+        sofort.TransactionRequest(["1-2-3", "4-5-6"]).to_xml(),
+        element(
+            "transaction_request",
+            None,
+            element("transaction", "1-2-3"),
+            element("transaction", "4-5-6"),
+            version="2",
+        ),
+    )
+
+
+def test_refunds_round_trip():
+    refunds = [
+        sofort.Refund("1-2-3", Decimal("10.00"), "Refund <1>", "FOOBAR", None),
+        sofort.Refund("4-5-6", Decimal("2.50"), None, "Event & more", "P-1"),
+    ]
+    xml = sofort.Refunds(refunds).to_xml()
+    assert_same_document(
+        xml,
+        element(
+            "refunds",
+            None,
+            element(
+                "refund",
+                None,
+                element("transaction", "1-2-3"),
+                element("amount", "10.00"),
+                element("comment", "Refund <1>"),
+                element("reason_1", "FOOBAR"),
+                element("reason_2"),
+            ),
+            element(
+                "refund",
+                None,
+                element("transaction", "4-5-6"),
+                element("amount", "2.50"),
+                element("comment"),
+                element("reason_1", "Event & more"),
+                element("reason_2", "P-1"),
+            ),
+            version="3",
+        ),
+    )
+
+    parsed = sofort.Refunds.from_xml(xml).refunds
+    for before, after in zip(refunds, parsed):
+        for f in ("transaction", "amount", "comment", "reason_1", "reason_2"):
+            assert getattr(after, f) == getattr(before, f)
+
+
+def test_transaction_details_keep_texts():
+    xml = TRANSACTIONS.format(status_modified="2010-04-14T17:01:08Z").encode()
+    td = sofort.Transactions.from_xml(xml).details[0]
+    assert td.status_modified == datetime(2010, 4, 14, 17, 1, 8, tzinfo=timezone.utc)
+    assert td.amount == Decimal("12.50")
+
+    data = td.to_data()
+    assert data["time"] == "2010-04-14T19:01:08+02:00"
+    assert data["status_modified"] == "2010-04-14T17:01:08Z"
+    assert data["exchange_rate"] == "1.0000"
+
+
+def test_transaction_details_invalid_time():
+    xml = TRANSACTIONS.format(status_modified="yesterday").encode()
+    with pytest.raises(sofort.SofortError):
+        sofort.Transactions.from_xml(xml)
@@ -0,0 +1,24 @@
+import pytest
+from datetime import timedelta
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+
+from pretix_sofort import tasks
+
+
+@pytest.mark.django_db
+def test_sweep_checks_stale_payments(rso, sofort_api):
+    with scopes_disabled():
+        OrderPayment.objects.filter(pk=rso.payment.pk).update(created=now() - timedelta(hours=1))
+        tasks.sweep_stale_payments.apply()
+        assert len(sofort_api.calls) == 1
+        rso.payment.refresh_from_db()
+        assert rso.payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+def test_sweep_skips_recent_payments(rso, sofort_api):
+    with scopes_disabled():
+        tasks.sweep_stale_payments.apply()
+        assert sofort_api.calls == []
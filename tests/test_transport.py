@@ -0,0 +1,47 @@
+import pytest
+from requests import ConnectionError, ConnectTimeout, ReadTimeout
+
+from pretix_sofort import transport
+
+
+class FailingSession:
+    def __init__(self, exc):
+        self.exc = exc
+        self.calls = 0
+
+    def post(self, *args, **kwargs):
+        self.calls += 1
+        raise self.exc()
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def make(exc):
+        s = FailingSession(exc)
+        monkeypatch.setattr(transport, "get_session", lambda *args: s)
+        return s
+
+    monkeypatch.setattr(transport, "RETRY_DELAY", 0)
+    return make
+
+
+@pytest.mark.parametrize("exc", [ConnectionError, ConnectTimeout])
+def test_lookup_retried_without_connection(session, exc):
+    s = session(exc)
+    with pytest.raises(exc):
+        transport.post("1", "key", b"", idempotent=True)
+    assert s.calls == 1 + transport.RETRIES
+
+
+def test_lookup_not_retried_after_read_timeout(session):
+    s = session(ReadTimeout)
+    with pytest.raises(ReadTimeout):
+        transport.post("1", "key", b"", idempotent=True)
+    assert s.calls == 1
+
+
+def test_request_not_retried(session):
+    s = session(ConnectionError)
+    with pytest.raises(ConnectionError):
+        transport.post("1", "key", b"")
+    assert s.calls == 1
@@ -0,0 +1,266 @@
+"""
+Benchmarks for building and parsing the XML documents exchanged with Sofort, and for processing a
+transaction end to end with a mocked Sofort API. Run from the repository root within your pretix
+development environment::
+
+    python tools/benchmark_codec.py
+
+To find out whether an upgrade of the plugin makes things slower, store a baseline with the version you
+are running now, then compare the new version against it::
+
+    python tools/benchmark_codec.py --save
+    git checkout <new version>
+    python tools/benchmark_codec.py --compare
+
+The comparison exits with status 1 if any benchmark got slower by more than ``--threshold``. Baselines
+are only meaningful on the machine they have been recorded on.
+
+The end-to-end benchmark creates a throwaway test database using ``pretix.testutils.settings``, unless
+``DJANGO_SETTINGS_MODULE`` says otherwise. Pass ``--codec-only`` to skip it.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pretix_sofort import sofort  # NOQA
+
+from benchmark_parser import build_response  # NOQA
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "..", ".benchmarks", "baseline.json")
+
+NEW_TRANSACTION = b"""<?xml version="1.0" encoding="UTF-8" ?>
+<new_transaction>
+    <transaction>12345-123456-56A3BE0E-ACAB</transaction>
+    <payment_url>https://www.sofort.com/payment/go/136b2012718da216af4c20c2ec2f51100c90406e</payment_url>
+    <warnings />
+</new_transaction>"""
+
+STATUS_NOTIFICATION = b"""<?xml version="1.0" encoding="UTF-8" ?>
+<status_notification>
+    <transaction>12345-123456-56A3BE0E-ACAB</transaction>
+    <time>2010-04-14T19:01:08+02:00</time>
+</status_notification>"""
+
+REFUNDS_RESPONSE = (
+    b'<?xml version="1.0" encoding="UTF-8" ?>\n<refunds version="3">'
+    + b"".join(
+        b"<refund><transaction>12345-123456-%08d-ABCD</transaction><amount>12.50</amount>"
+        b"<comment>ABCDE-1</comment><reason_1>ABCDE-1</reason_1><reason_2>12345</reason_2>"
+        b"<status>ok</status><time>2010-04-14T19:01:08+02:00</time></refund>" % i
+        for i in range(100)
+    )
+    + b"</refunds>"
+)
+
+
+def multipay():
+    return sofort.MultiPay(
+        project_id="12345",
+        amount=Decimal("12.50"),
+        currency_code="EUR",
+        reasons=["DEMO-ABCDE-1", "-TRANSACTION-"],
+        user_variables=["DEMO-ABCDE-1"],
+        success_url="https://pretix.eu/demo/democon/sofort/return/ABCDE/0123456789abcdef/"
+        "?state=success&transaction=-TRANSACTION-",
+        abort_url="https://pretix.eu/demo/democon/sofort/return/ABCDE/0123456789abcdef/"
+        "?state=abort&transaction=-TRANSACTION-",
+        timeout_url="https://pretix.eu/demo/democon/sofort/return/ABCDE/0123456789abcdef/"
+        "?state=timeout&transaction=-TRANSACTION-",
+        notification_urls=["https://pretix.eu/demo/democon/sofort/webhook/"],
+    )
+
+
+def refunds(n):
+    return sofort.Refunds(
+        refunds=[
+            sofort.Refund(
+                transaction="12345-123456-%08d-ABCD" % i,
+                amount=Decimal("12.50"),
+                comment="DEMO-ABCDE-1",
+                reason_1="DEMO-ABCDE-1",
+                reason_2="12345-123456-%08d-ABCD" % i,
+            )
+            for i in range(n)
+        ]
+    )
+
+
+def codec_cases():
+    mp = multipay()
+    tr = sofort.TransactionRequest(
+        transactions=["12345-123456-%08d-ABCD" % i for i in range(100)]
+    )
+    rf = refunds(100)
+    transactions = build_response(100)
+    td = sofort.Transactions.from_xml(build_response(1)).details[0]
+
+    def to_data():
+        # Measure building the redacted payload, not looking it up
+        td._redacted = None
+        return td.to_data(no_sepa_data=True)
+
+    return [
+        ("MultiPay.to_xml", mp.to_xml),
+        ("TransactionRequest.to_xml (100)", tr.to_xml),
+        ("Refunds.to_xml (100)", rf.to_xml),
+        ("NewTransaction.from_xml", lambda: sofort.NewTransaction.from_xml(NEW_TRANSACTION)),
+        ("StatusNotification.from_xml", lambda: sofort.StatusNotification.from_xml(STATUS_NOTIFICATION)),
+        ("Refunds.from_xml (100)", lambda: sofort.Refunds.from_xml(REFUNDS_RESPONSE)),
+        ("Transactions.from_xml (100)", lambda: sofort.Transactions.from_xml(transactions)),
+        ("TransactionDetails.to_data", to_data),
+    ]
+
+
+class Response:
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+
+def process_result_cases():
+    """
+    Sets up a test database with an event, an order and a Sofort payment, and returns a benchmark of
+    ``process_result`` handling a status notification for it. The Sofort API is replaced by a function
+    answering with canned transaction details, so only our own code and the database are measured.
+    """
+    import atexit
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pretix.testutils.settings")
+    django.setup()
+
+    from datetime import timedelta
+    from django.db import connection, transaction
+    from django.test import RequestFactory
+    from django.test.utils import setup_test_environment
+    from django.utils.timezone import now
+    from django_scopes import scopes_disabled
+    from pretix.base.models import Event, Order, OrderPayment, Organizer
+
+    from pretix_sofort import transport
+    from pretix_sofort.models import ReferencedSofortTransaction
+    from pretix_sofort.views import process_result
+
+    setup_test_environment()
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    atexit.register(connection.creation.destroy_test_db, old_name, verbosity=0)
+
+    details = build_response(1)
+    reference = sofort.Transactions.from_xml(details).details[0].transaction
+    transport.post = lambda *args, **kwargs: Response(details)
+
+    with scopes_disabled(), transaction.atomic():
+        organizer = Organizer.objects.create(name="Benchmark", slug="benchmark")
+        event = Event.objects.create(
+            organizer=organizer, name="Benchmark", slug="benchmark", date_from=now(), plugins="pretix_sofort", live=True
+        )
+        event.settings.set("payment_sofort__enabled", True)
+        event.settings.set("payment_sofort_customer_id", "12345")
+        event.settings.set("payment_sofort_api_key", "secret")
+        event.settings.set("payment_sofort_project_id", "12345")
+        kwargs = {}
+        if hasattr(organizer, "sales_channels"):
+            kwargs["sales_channel"] = organizer.sales_channels.get(identifier="web")
+        order = Order.objects.create(
+            event=event, email="dummy@example.org", status=Order.STATUS_PENDING, datetime=now(),
+            expires=now() + timedelta(days=10), total=Decimal("12.50"), **kwargs
+        )
+        order.create_transactions()
+        payment = order.payments.create(
+            provider="sofort", amount=Decimal("12.50"), state=OrderPayment.PAYMENT_STATE_CREATED
+        )
+        rso = ReferencedSofortTransaction.objects.create(order=order, payment=payment, reference=reference)
+
+    request = RequestFactory().post("/")
+    request.event = event
+
+    def run():
+        # Notifications newer than anything we fetched before bypass all caches, so every round talks
+        # to the (mocked) API and applies the result, just like a webhook does.
+        with scopes_disabled():
+            process_result(request, rso, warn=False, notification_time=now() + timedelta(days=1))
+
+    # The first round confirms the payment, every further one is a repeated notification
+    run()
+    return [("process_result", run)]
+
+
+def measure(f, min_time=0.2):
+    number = 1
+    while True:
+        t = timeit.timeit(f, number=number)
+        if t >= min_time:
+            break
+        number *= 2
+    return min(timeit.repeat(f, number=number, repeat=5)) / number
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print("{:<36} {:>14} {:>14} {:>8}".format("", "baseline", "current", "change"))
+    for name, t in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print("{:<36} {:>12.2f}us".format(name, t * 1e6))
+            continue
+        change = t / base - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<36} {:>12.2f}us {:>12.2f}us {:>+8.1%}{}".format(name, base * 1e6, t * 1e6, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--save", metavar="FILE", nargs="?", const=DEFAULT_BASELINE,
+                        help="store the results as a baseline (default: %(const)s)")
+    parser.add_argument("--compare", metavar="FILE", nargs="?", const=DEFAULT_BASELINE,
+                        help="compare the results against a stored baseline (default: %(const)s)")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown at which a benchmark counts as a regression (default: %(default)s)")
+    parser.add_argument("--codec-only", action="store_true", help="skip the end-to-end benchmark")
+    options = parser.parse_args()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if baseline["python"] != platform.python_version():
+            print("Warning: the baseline has been recorded with Python {}.".format(baseline["python"]))
+
+    cases = codec_cases()
+    if not options.codec_only:
+        cases += process_result_cases()
+
+    results = {}
+    for name, f in cases:
+        results[name] = measure(f)
+        if baseline is None:
+            print("{:<36} {:>12.2f}us".format(name, results[name] * 1e6))
+
+    if options.save:
+        os.makedirs(os.path.dirname(os.path.abspath(options.save)), exist_ok=True)
+        with open(options.save, "w") as f:
+            json.dump({"python": platform.python_version(), "results": results}, f, indent=4)
+
+    if baseline is not None:
+        regressions = compare(results, baseline["results"], options.threshold)
+        if regressions:
+            print("{} of {} benchmarks got slower by more than {:.0%}.".format(
+                len(regressions), len(results), options.threshold
+            ))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
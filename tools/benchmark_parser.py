@@ -0,0 +1,127 @@
+"""
+Compares the streaming parser for Sofort transaction responses against the previous tree-based
+implementation. Run from the repository root within your pretix development environment::
+
+    python tools/benchmark_parser.py
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pretix_sofort import sofort  # NOQA
+
+TRANSACTION_DETAILS = """
+    <transaction_details>
+        <project_id>12345</project_id>
+        <transaction>12345-123456-{i:08d}-ABCD</transaction>
+        <test>1</test>
+        <time>2010-04-14T19:01:08+02:00</time>
+        <status>received</status>
+        <status_reason>credited</status_reason>
+        <status_modified>2010-04-15T08:12:01+02:00</status_modified>
+        <payment_method>su</payment_method>
+        <language_code>de</language_code>
+        <amount>12.50</amount>
+        <amount_refunded>0.00</amount_refunded>
+        <currency_code>EUR</currency_code>
+        <reasons>
+            <reason>ABCDE-1</reason>
+            <reason>12345-123456-{i:08d}-ABCD</reason>
+        </reasons>
+        <user_variables>
+            <user_variable>ABCDE-1</user_variable>
+        </user_variables>
+        <sender>
+            <holder>Max Mustermann</holder>
+            <account_number>2345678</account_number>
+            <bank_code>00000</bank_code>
+            <bank_name>Demo Bank</bank_name>
+            <bic>SFRTDE20XXX</bic>
+            <iban>DE86000000002345678902</iban>
+            <country_code>DE</country_code>
+        </sender>
+        <recipient>
+            <holder>Event GmbH</holder>
+            <account_number>23456789</account_number>
+            <bank_code>00000</bank_code>
+            <bank_name>Demo Bank</bank_name>
+            <bic>SFRTDE20XXX</bic>
+            <iban>DE06000000000023456789</iban>
+            <country_code>DE</country_code>
+        </recipient>
+        <email_customer />
+        <phone_customer />
+        <exchange_rate>1.0000</exchange_rate>
+        <costs>
+            <fees>0.60</fees>
+            <currency_code>EUR</currency_code>
+            <exchange_rate>1.0000</exchange_rate>
+        </costs>
+    </transaction_details>"""
+
+
+def build_response(n):
+    return (
+        '<?xml version="1.0" encoding="UTF-8" ?>\n<transactions>'
+        + "".join(TRANSACTION_DETAILS.format(i=i) for i in range(n))
+        + "\n</transactions>"
+    ).encode()
+
+
+class LegacyTransactionDetails:
+    pass
+
+
+def legacy_from_xml(xml):
+    # The tree-based parser and the plain objects used up to pretix-sofort 1.4
+    root = etree.fromstring(xml)
+    tdos = []
+    for td in root.xpath("/transactions/transaction_details"):
+        tdo = LegacyTransactionDetails()
+        for f in sofort.TransactionDetails.SIMPLE_FIELDS:
+            setattr(tdo, f, td.xpath("{}".format(f))[0].text)
+        tdo.reasons = [r.text for r in td.xpath("reasons/reason")]
+        tdo.user_variables = [r.text for r in td.xpath("user_variables/user_variable")]
+        tdo.sender = {r.tag: r.text for r in td.xpath("sender")[0]}
+        tdo.recipient = {r.tag: r.text for r in td.xpath("recipient")[0]}
+        tdo.costs = {r.tag: r.text for r in td.xpath("costs")[0]}
+        tdos.append(tdo)
+    return tdos
+
+
+def streaming_from_xml(xml):
+    # Consume the generator without keeping the results, the way batch reconciliation would
+    for _ in sofort.Transactions.iter_xml(xml):
+        pass
+
+
+def peak_memory(f, xml):
+    tracemalloc.start()
+    f(xml)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    print("{:>8} {:>10} {:>14} {:>14} {:>12} {:>12}".format(
+        "entries", "impl", "time/call", "time/entry", "peak mem", "speedup"
+    ))
+    for n in (1, 100, 10000):
+        xml = build_response(n)
+        number = max(1, 2000 // n)
+        results = {}
+        for name, f in (("legacy", legacy_from_xml), ("streaming", streaming_from_xml)):
+            t = min(timeit.repeat(lambda: f(xml), number=number, repeat=5)) / number
+            results[name] = t
+            print("{:>8} {:>10} {:>12.3f}ms {:>12.2f}us {:>10.0f}kB {:>11.2f}x".format(
+                n, name, t * 1000, t / n * 1e6, peak_memory(f, xml) / 1024, results["legacy"] / t
+            ))
+
+
+if __name__ == "__main__":
+    main()
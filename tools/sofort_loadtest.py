@@ -0,0 +1,158 @@
+"""
+Load test for the Sofort flows of pretix, to be used with ``tools/sofort_simulator.py``. Run from the
+repository root within your pretix development environment::
+
+    python tools/sofort_loadtest.py return --requests 2000 --concurrency 20
+
+Scenarios:
+
+``checkout``
+    Builds ``multipay`` requests with the plugin's codec and sends them through the plugin's pooled
+    transport to the simulator, i.e. the part of ``Sofort.execute_payment`` that talks to Sofort. pretix's
+    own checkout steps are not part of this scenario.
+
+``return``
+    Replays the customer's return to pretix (``ReturnView``) for transactions known to the simulator.
+
+``webhook``
+    Sends status notifications to pretix's webhook for transactions known to the simulator.
+
+Transactions are known to the simulator once they have been started by pretix, e.g. by placing a few
+orders with Sofort in your local shop. Every transaction is used over and over again.
+"""
+import argparse
+import os
+import requests
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from itertools import cycle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def checkout_requests(options):
+    # The transport needs Django settings, so we only import the plugin for this scenario
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pretix.settings")
+    django.setup()
+    from pretix_sofort import sofort, transport
+
+    def run(i):
+        mp = sofort.MultiPay(
+            project_id="12345",
+            amount=Decimal("12.50"),
+            currency_code="EUR",
+            reasons=["LOADTEST-{}".format(i), "-TRANSACTION-"],
+            user_variables=["LOADTEST-{}".format(i)],
+            success_url="http://localhost/return/?state=success&transaction=-TRANSACTION-",
+            abort_url="http://localhost/return/?state=abort&transaction=-TRANSACTION-",
+            timeout_url="http://localhost/return/?state=timeout&transaction=-TRANSACTION-",
+            notification_urls=[],
+        )
+        r = transport.post("loadtest", "loadtest", mp.to_xml(), url=options.simulator + "/api/xml")
+        sofort.NewTransaction.from_xml(r.content)
+
+    return run
+
+
+def known_transactions(options):
+    transactions = [
+        t for t in requests.get(options.simulator + "/_transactions").json()
+        if t["success_url"] and t["notification_urls"]
+    ]
+    if not transactions:
+        sys.exit("The simulator does not know any transactions started by pretix yet.")
+    return cycle(transactions)
+
+
+def return_requests(options):
+    transactions = known_transactions(options)
+    lock = threading.Lock()
+    local = threading.local()
+
+    def run(i):
+        with lock:
+            t = next(transactions)
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        r = local.session.get(t["success_url"], allow_redirects=False)
+        r.raise_for_status()
+
+    return run
+
+
+def webhook_requests(options):
+    transactions = known_transactions(options)
+    lock = threading.Lock()
+    local = threading.local()
+
+    def run(i):
+        with lock:
+            t = next(transactions)
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        r = local.session.post(
+            t["notification_urls"][0],
+            data=(
+                '<?xml version="1.0" encoding="UTF-8" ?>\n<status_notification><transaction>{}</transaction>'
+                "<time>{}</time></status_notification>"
+            ).format(t["transaction"], time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime())),
+            headers={"Content-Type": "application/xml"},
+        )
+        r.raise_for_status()
+
+    return run
+
+
+SCENARIOS = {
+    "checkout": checkout_requests,
+    "return": return_requests,
+    "webhook": webhook_requests,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the Sofort flows of pretix")
+    parser.add_argument("scenario", choices=SCENARIOS.keys())
+    parser.add_argument("--simulator", default="http://127.0.0.1:8089")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    options = parser.parse_args()
+
+    run = SCENARIOS[options.scenario](options)
+    durations = []
+    errors = []
+
+    def timed(i):
+        t0 = time.perf_counter()
+        try:
+            run(i)
+        except Exception as e:
+            errors.append(e)
+        else:
+            durations.append(time.perf_counter() - t0)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        list(executor.map(timed, range(options.requests)))
+    elapsed = time.perf_counter() - start
+
+    print("{} requests in {:.2f}s, {:.1f} requests/s, {} errors".format(
+        options.requests, elapsed, options.requests / elapsed, len(errors)
+    ))
+    if len(durations) >= 2:
+        q = statistics.quantiles(durations, n=100)
+        print("latency p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            q[49] * 1000, q[98] * 1000, max(durations) * 1000
+        ))
+    if errors:
+        print("first error: {!r}".format(errors[0]))
+
+
+if __name__ == "__main__":
+    main()
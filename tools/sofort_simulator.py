@@ -0,0 +1,273 @@
+"""
+A local stand-in for the Sofort XML API, for development and load tests. It implements the ``multipay``,
+``transaction_request`` and ``refunds`` requests, simulates customers paying and sends status notifications
+to the notification URLs given by pretix. It only needs lxml::
+
+    python tools/sofort_simulator.py --port 8089 --latency 150 --error-rate 0.01
+
+and in the ``[sofort]`` section of your ``pretix.cfg``::
+
+    api_url=http://localhost:8089/api/xml
+
+Payment URLs returned by the simulator complete the payment immediately and redirect to the success URL.
+Afterwards, the transaction walks through the statuses given with ``--progression``, ``--step`` seconds
+apart, and a notification is sent for every step. ``GET /_transactions`` lists all known transactions.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from lxml import etree
+from xml.sax.saxutils import escape
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" ?>\n'
+
+
+class Transaction:
+    def __init__(self, project_id, amount, currency_code, reasons, user_variables, success_url,
+                 abort_url, notification_urls):
+        self.id = "99999-{}-{}".format(random.randint(100000, 999999), uuid.uuid4().hex[:13].upper())
+        self.project_id = project_id
+        self.amount = Decimal(amount)
+        self.amount_refunded = Decimal("0.00")
+        self.currency_code = currency_code
+        self.reasons = reasons
+        self.user_variables = user_variables
+        self.success_url = success_url
+        self.abort_url = abort_url
+        self.notification_urls = notification_urls
+        self.time = now()
+        self.status = "untraceable"
+        self.status_reason = "sofort_bank_account_needed"
+        self.status_modified = self.time
+
+    def set_status(self, status, reason):
+        self.status = status
+        self.status_reason = reason
+        self.status_modified = now()
+
+    def to_xml(self):
+        def el(tag, value):
+            return "<{0}>{1}</{0}>".format(tag, escape(str(value))) if value is not None else "<{}/>".format(tag)
+
+        account = (
+            "<holder>Max Mustermann</holder><account_number>2345678</account_number><bank_code>88888888</bank_code>"
+            "<bank_name>Demo Bank</bank_name><bic>SFRTDE20XXX</bic><iban>DE06888888880023456789</iban>"
+            "<country_code>DE</country_code>"
+        )
+        return "".join([
+            "<transaction_details>",
+            el("project_id", self.project_id),
+            el("transaction", self.id),
+            el("test", 1),
+            el("time", self.time),
+            el("status", self.status),
+            el("status_reason", self.status_reason),
+            el("status_modified", self.status_modified),
+            el("payment_method", "su"),
+            el("language_code", "de"),
+            el("amount", self.amount),
+            el("amount_refunded", self.amount_refunded),
+            el("currency_code", self.currency_code),
+            "<reasons>", "".join(el("reason", r) for r in self.reasons), "</reasons>",
+            "<user_variables>", "".join(el("user_variable", r) for r in self.user_variables), "</user_variables>",
+            "<sender>", account, "</sender>",
+            "<recipient>", account, "</recipient>",
+            el("email_customer", None),
+            el("phone_customer", None),
+            el("exchange_rate", "1.0000"),
+            "<costs><fees>0.25</fees><currency_code>EUR</currency_code><exchange_rate>1.0000</exchange_rate></costs>",
+            "</transaction_details>",
+        ])
+
+    def to_json(self):
+        return {
+            "transaction": self.id,
+            "status": self.status,
+            "amount": str(self.amount),
+            "amount_refunded": str(self.amount_refunded),
+            "success_url": self.success_url.replace("-TRANSACTION-", self.id) if self.success_url else None,
+            "notification_urls": self.notification_urls,
+        }
+
+
+def now():
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def texts(root, path):
+    return [e.text for e in root.xpath(path)]
+
+
+class Simulator:
+    def __init__(self, options):
+        self.options = options
+        self.transactions = {}
+        self.lock = threading.Lock()
+
+    def replace_placeholder(self, url, t):
+        return url.replace("-TRANSACTION-", t.id) if url else url
+
+    def multipay(self, root):
+        t = Transaction(
+            project_id=root.findtext("project_id"),
+            amount=root.findtext("amount"),
+            currency_code=root.findtext("currency_code"),
+            reasons=texts(root, "reasons/reason"),
+            user_variables=texts(root, "user_variables/*"),
+            success_url=root.findtext("success_url"),
+            abort_url=root.findtext("abort_url"),
+            notification_urls=texts(root, "notification_urls/notification_url"),
+        )
+        t.reasons = [self.replace_placeholder(r, t) for r in t.reasons]
+        with self.lock:
+            self.transactions[t.id] = t
+        return (
+            XML_HEADER + "<new_transaction><transaction>{}</transaction>"
+            "<payment_url>{}</payment_url></new_transaction>"
+        ).format(t.id, escape("{}/pay/{}".format(self.options.base_url, t.id)))
+
+    def transaction_request(self, root):
+        with self.lock:
+            found = [self.transactions[i] for i in texts(root, "transaction") if i in self.transactions]
+            return XML_HEADER + "<transactions>{}</transactions>".format("".join(t.to_xml() for t in found))
+
+    def refunds(self, root):
+        out = []
+        for r in root.xpath("refund"):
+            errors = ""
+            with self.lock:
+                t = self.transactions.get(r.findtext("transaction"))
+                amount = Decimal(r.findtext("amount"))
+                if t is None or t.amount_refunded + amount > t.amount:
+                    status = "error"
+                    errors = "<errors><error><code>7004</code><message>Refund not possible.</message></error></errors>"
+                else:
+                    t.amount_refunded += amount
+                    t.set_status("refunded", "refunded" if t.amount_refunded == t.amount else "compensation")
+                    status = "ok"
+            fields = "".join(
+                "<{0}>{1}</{0}>".format(f, escape(r.findtext(f) or ""))
+                for f in ("transaction", "amount", "comment", "reason_1", "reason_2")
+            )
+            out.append("<refund>{}<status>{}</status>{}<time>{}</time></refund>".format(fields, status, errors, now()))
+            if status == "ok":
+                self.notify(t)
+        return XML_HEADER + '<refunds version="3">{}</refunds>'.format("".join(out))
+
+    def pay(self, transaction_id):
+        with self.lock:
+            t = self.transactions.get(transaction_id)
+        if t is None:
+            return None
+        threading.Thread(target=self.progress, args=(t,), daemon=True).start()
+        return self.replace_placeholder(t.success_url, t)
+
+    def progress(self, t):
+        for i, status in enumerate(self.options.progression.split(",")):
+            if i:
+                time.sleep(self.options.step)
+            with self.lock:
+                t.set_status(status, status)
+            self.notify(t)
+
+    def notify(self, t):
+        body = (
+            XML_HEADER + "<status_notification><transaction>{}</transaction><time>{}</time></status_notification>"
+        ).format(t.id, t.status_modified).encode()
+        for url in t.notification_urls:
+            try:
+                urllib.request.urlopen(
+                    urllib.request.Request(url, data=body, headers={"Content-Type": "application/xml"}),
+                    timeout=10,
+                ).read()
+            except OSError as e:
+                print("Notification to {} failed: {}".format(url, e))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    simulator = None
+
+    def respond(self, status, body, content_type="application/xml; charset=UTF-8", headers=None):
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == "/_transactions":
+            with self.simulator.lock:
+                data = [t.to_json() for t in self.simulator.transactions.values()]
+            return self.respond(200, json.dumps(data), "application/json")
+        if path.startswith("/pay/"):
+            url = self.simulator.pay(path[len("/pay/"):])
+            if url:
+                return self.respond(302, b"", "text/plain", {"Location": url})
+        self.respond(404, b"Not found", "text/plain")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        options = self.simulator.options
+        if options.latency:
+            time.sleep(max(0.0, random.gauss(options.latency, options.latency / 4)) / 1000)
+        if random.random() < options.error_rate:
+            return self.respond(503, b"Service unavailable", "text/plain")
+
+        try:
+            root = etree.fromstring(body)
+        except etree.XMLSyntaxError:
+            return self.respond(
+                200,
+                XML_HEADER + "<errors><error><code>8010</code><message>Invalid XML.</message></error></errors>",
+            )
+        handler = {
+            "multipay": self.simulator.multipay,
+            "transaction_request": self.simulator.transaction_request,
+            "refunds": self.simulator.refunds,
+        }.get(root.tag)
+        if handler is None:
+            return self.respond(
+                200,
+                XML_HEADER + "<errors><error><code>8011</code><message>Unknown request.</message></error></errors>",
+            )
+        self.respond(200, handler(root))
+
+    def log_message(self, format, *args):
+        if self.simulator.options.verbose:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Sofort API simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0, help="Mean response latency in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of API calls answered with HTTP 503")
+    parser.add_argument("--progression", default="pending,received",
+                        help="Comma-separated statuses a transaction goes through after payment")
+    parser.add_argument("--step", type=float, default=5, help="Seconds between two status changes")
+    parser.add_argument("--verbose", action="store_true")
+    options = parser.parse_args()
+    options.base_url = "http://{}:{}".format(options.host, options.port)
+
+    Handler.simulator = Simulator(options)
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    print("Sofort simulator listening on {}/api/xml".format(options.base_url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()